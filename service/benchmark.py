@@ -0,0 +1,209 @@
+import json
+import time
+import random
+import argparse
+import numpy as np
+import multiprocessing as mp
+
+from typing import Any, Callable, Dict, List, Tuple
+
+from sentinel import Config, DataHub
+from sentinel.model import Snapshot
+from raster import compose_sentinel1_arrays
+from utils import get_peak_rss, get_rss, reset_peak_rss
+
+
+def make_feed(entries: int, seed: int = 0) -> str:
+    # Synthetic hub response (the JSON layout of the OpenSearch API)
+    rng = random.Random(seed)
+    items: List[Dict[str, Any]] = []
+    for i in range(entries):
+        x, y = rng.uniform(-180, 170), rng.uniform(-80, 70)
+        footprint = (f"MULTIPOLYGON ((({x} {y}, {x + 2.5} {y}, "
+                     f"{x + 2.5} {y + 2.1}, {x} {y + 2.1}, {x} {y})))")
+        date = f"2020-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        time_ = f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00.000Z"
+        uuid = f"{i:08x}-0000-4000-8000-{rng.getrandbits(48):012x}"
+        items.append({
+            'title': f"S2A_MSIL2A_{date.replace('-', '')}T000000_{i:06d}",
+            'link': [
+                {'href': f"https://hub/odata/v1/Products('{uuid}')/$value"},
+                {'rel': 'alternative',
+                 'href': f"https://hub/odata/v1/Products('{uuid}')/"},
+                {'rel': 'icon',
+                 'href': f"https://hub/odata/v1/Products('{uuid}')/"
+                         f"Products('Quicklook')/$value"}
+            ],
+            'id': uuid,
+            'summary': f"Date: {date}T{time_}, Instrument: MSI, Size: 1 GB",
+            'date': [
+                {'name': 'ingestiondate', 'content': f"{date}T{time_}"},
+                {'name': 'beginposition', 'content': f"{date}T{time_}"},
+                {'name': 'endposition', 'content': f"{date}T{time_}"}
+            ],
+            'double': {'name': 'cloudcoverpercentage',
+                       'content': f"{rng.uniform(0, 100):.4f}"},
+            'str': [
+                {'name': 'size', 'content': '1.07 GB'},
+                {'name': 'platformname', 'content': 'Sentinel-2'},
+                {'name': 'footprint', 'content': footprint},
+                {'name': 'producttype', 'content': 'S2MSI2A'},
+                {'name': 'instrumentshortname', 'content': 'MSI'},
+                {'name': 'uuid', 'content': uuid}
+            ]
+        })
+
+    return json.dumps({'feed': {'opensearch:totalResults': str(entries),
+                                'entry': items}})
+
+
+def measure(name: str, decode: Callable[[str], List[Snapshot]],
+        text: str, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        snapshots = decode(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    rate = len(snapshots) / best
+    print(f"{name:>24s}: {rate:12,.0f} entries/s ({best:.3f} s)")
+
+    return rate
+
+
+def bench_decode(args: argparse.Namespace) -> None:
+    text = make_feed(args.entries)
+    data_hub = DataHub(Config())
+    print(f"Decoding {args.entries} feed entries (best of {args.repeat})")
+
+    def schema(text: str) -> List[Snapshot]:
+        # Previous path: a schema per entry, footprints parsed eagerly
+        entries = json.loads(text)['feed']['entry']
+        snapshots = []
+        for item in entries:
+            # A fresh Snapshot.Schema() per entry, as the replaced code did
+            data_hub.schema = Snapshot.Schema()
+            snapshots.append(data_hub.compose_snapshot_schema(item))
+        return [snapshot for snapshot in snapshots
+                if snapshot.polygon is not None]
+
+    def direct(text: str) -> List[Snapshot]:
+        entries = json.loads(text)['feed']['entry']
+        return [data_hub.compose_snapshot(item) for item in entries]
+
+    def footprints(text: str) -> List[Snapshot]:
+        snapshots = direct(text)
+        return [snapshot for snapshot in snapshots
+                if snapshot.polygon is not None]
+
+    base = measure('schema (eager)', schema, text, args.repeat)
+    rate = measure('direct', direct, text, args.repeat)
+    measure('direct + footprints', footprints, text, args.repeat)
+    print(f"{'speedup':>24s}: {rate / base:12.1f}x")
+
+    return None
+
+
+def make_scene(size: int, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    # Synthetic EW GRD polarizations (uint16 speckle, nodata margins)
+    rng = np.random.RandomState(seed) # default_rng needs NumPy 1.17
+    image_hh = rng.gamma(1.5, 400, (size, size)).astype(np.uint16)
+    image_hv = rng.gamma(1.5, 120, (size, size)).astype(np.uint16)
+    margin = size // 20
+    for image in (image_hh, image_hv):
+        image[:, :margin] = 0
+        image[:margin // 2, :] = 0
+        image[:, size - margin // 3:] = 0
+
+    return image_hh, image_hv
+
+
+def compose_masked(image_hh: np.ndarray, image_hv: np.ndarray
+    ) -> Tuple[np.ndarray, ...]:
+    # Previous masked array composite (reference)
+    image_hh = np.ma.array(image_hh, mask=image_hh == 0, dtype=np.float32)
+    image_hv = np.ma.array(image_hv, mask=image_hv == 0, dtype=np.float32)
+    stats_hh = (image_hh.mean().astype(np.float32),
+                image_hh.std().astype(np.float32))
+    stats_hv = (image_hv.mean().astype(np.float32),
+                image_hv.std().astype(np.float32))
+    image_hh = np.ma.tanh(image_hh / (stats_hh[0] + 2 * stats_hh[1]))
+    image_hv = np.ma.tanh(image_hv / (stats_hv[0] + 2 * stats_hv[1]))
+    image_ratio = image_hh / image_hv
+    image_ratio = image_ratio / image_ratio.max()
+    image_negative = np.float32(1) - np.ma.tanh(image_hh / image_hv)
+    images = [(image * 254 + 1).astype(np.uint8)
+              for image in (image_hh, image_hv, image_ratio, image_negative)]
+
+    return tuple(np.ma.getdata(image) for image in images)
+
+
+COMPOSERS = {'masked': compose_masked, 'fused': compose_sentinel1_arrays}
+
+
+def run_compose(name: str, size: int, connection: Any) -> None:
+    # In a child process: the peak RSS is of this composer only
+    image_hh, image_hv = make_scene(size)
+    baseline = get_rss()
+    reset = reset_peak_rss()
+    start = time.perf_counter()
+    images = COMPOSERS[name](image_hh, image_hv)
+    elapsed = time.perf_counter() - start
+    peak = get_peak_rss() - (baseline if reset else 0)
+    digest = [np.bincount(image.ravel(), minlength=256) for image in images]
+    connection.send((elapsed, peak, reset, images if size <= 2048
+                                            else digest))
+    connection.close()
+
+    return None
+
+
+def bench_compose(args: argparse.Namespace) -> None:
+    print(f"Composing a {args.size}x{args.size} scene",
+          f"({args.size ** 2 * 4 / 1048576:.0f} MiB of HH/HV)")
+    context = mp.get_context('spawn')
+    results = {}
+    for name in COMPOSERS:
+        reader, writer = context.Pipe(duplex=False)
+        process = context.Process(target=run_compose,
+                                  args=(name, args.size, writer))
+        process.start()
+        results[name] = reader.recv()
+        process.join()
+        elapsed, peak, reset, _ = results[name]
+        print(f"{name:>24s}: {elapsed:8.3f} s, peak RSS",
+              f"{'+' if reset else ''}{peak / 1048576:,.0f} MiB")
+    base, fused = results['masked'][3], results['fused'][3]
+    for band, a, b in zip(('HH', 'HV', 'ratio', 'negative'), base, fused):
+        if args.size <= 2048:
+            differ = np.count_nonzero(a.astype(np.int16) - b)
+            print(f"{band:>24s}: {differ} pixels differ,",
+                  f"max {np.abs(a.astype(np.int16) - b).max()}")
+        else:
+            print(f"{band:>24s}: histogram difference",
+                  f"{np.abs(a - b).sum() // 2} pixels")
+    print(f"{'speedup':>24s}: {results['masked'][0] / results['fused'][0]:.1f}x")
+
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='GPS microbenchmarks')
+    subparsers = parser.add_subparsers(dest='target')
+    parser_decode = subparsers.add_parser('decode',
+                                          help='search response decoding')
+    parser_decode.add_argument('-n', '--entries', default=10000, type=int,
+                               help='feed entries to decode')
+    parser_decode.add_argument('-r', '--repeat', default=3, type=int,
+                               help='runs (the best one is reported)')
+    parser_decode.set_defaults(run=bench_decode)
+    parser_compose = subparsers.add_parser('compose',
+                                           help='Sentinel-1 RGB composite')
+    parser_compose.add_argument('-s', '--size', default=10000, type=int,
+                                help='scene side (pixels, EW GRD ~10000)')
+    parser_compose.set_defaults(run=bench_compose)
+
+    args = parser.parse_args()
+    if not args.target:
+        parser.error('benchmark target required')
+    args.run(args)
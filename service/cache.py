@@ -0,0 +1,113 @@
+import os
+import shutil
+import threading
+
+from typing import Dict, Tuple
+
+
+MiB: int = 1048576
+
+
+class ProductCache:
+    # Local product store keyed by snapshot UUID ('<root>/<uuid>/<file>'),
+    # survives cycles and restarts (the index is rebuilt from the directory,
+    # file mtime is the LRU clock). Least recently used products are evicted
+    # to keep the total under the byte budget; pinned (in use) products are
+    # never evicted
+    def __init__(self, root: str, budget: int = 20480 * MiB) -> None:
+        self.root = root
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[str, Tuple[str, int, float]] = {}
+        self._pins: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        for uuid in os.listdir(root):
+            path = os.path.join(root, uuid)
+            files = os.listdir(path) if os.path.isdir(path) else []
+            if len(files) != 1 or files[0].endswith(('.part', '.part.json')):
+                # Not a cache entry (or an incomplete one, e.g. a download)
+                continue
+            filename = os.path.join(path, files[0])
+            stat = os.stat(filename)
+            self._entries[uuid] = (filename, stat.st_size, stat.st_mtime)
+
+    @property
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries.values())
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries), 'bytes': self.size}
+
+    def get(self, uuid: str, pin: bool = False) -> str:
+        with self._lock:
+            entry = self._entries.get(uuid)
+            if entry is None or not os.path.isfile(entry[0]):
+                self._entries.pop(uuid, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(uuid)
+            if pin:
+                self._pins[uuid] = self._pins.get(uuid, 0) + 1
+
+            return entry[0]
+
+    def put(self, uuid: str, filename: str, pin: bool = False) -> str:
+        # Move the file into the cache, return its cached path
+        path = os.path.join(self.root, uuid)
+        target = os.path.join(path, os.path.basename(filename))
+        with self._lock:
+            if os.path.abspath(filename) != os.path.abspath(target):
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                os.makedirs(path)
+                shutil.move(filename, target)
+            self._entries[uuid] = (target, os.stat(target).st_size, 0.0)
+            self._touch(uuid)
+            if pin:
+                self._pins[uuid] = self._pins.get(uuid, 0) + 1
+            self._evict()
+
+        return target
+
+    def pin(self, uuid: str) -> None:
+        with self._lock:
+            self._pins[uuid] = self._pins.get(uuid, 0) + 1
+
+        return None
+
+    def unpin(self, uuid: str) -> None:
+        with self._lock:
+            pins = self._pins.get(uuid, 0) - 1
+            if pins > 0:
+                self._pins[uuid] = pins
+            else:
+                self._pins.pop(uuid, None)
+            self._evict()
+
+        return None
+
+    def _touch(self, uuid: str) -> None:
+        filename, size, _ = self._entries[uuid]
+        os.utime(filename)
+        self._entries[uuid] = (filename, size, os.stat(filename).st_mtime)
+
+        return None
+
+    def _evict(self) -> None:
+        total = self.size
+        for uuid in sorted(self._entries, key=lambda k: self._entries[k][2]):
+            if total <= self.budget:
+                break
+            if uuid in self._pins:
+                continue
+            filename, size, _ = self._entries.pop(uuid)
+            shutil.rmtree(os.path.dirname(filename), ignore_errors=True)
+            total -= size
+
+        return None
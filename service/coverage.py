@@ -0,0 +1,117 @@
+from typing import Any, Dict, List, Tuple
+
+from osgeo import ogr, osr
+from shapely import wkb, wkt
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+
+def get_lonlat() -> osr.SpatialReference:
+    reference = osr.SpatialReference()
+    reference.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        # GDAL 3: keep (lon, lat) order as in hub footprints and GeoJSON
+        reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    return reference
+
+
+def read_shapes(filename: str) -> Any:
+    # Union of the shapefile geometries in lon/lat (EPSG:4326)
+    source = ogr.Open(filename)
+    if source is None:
+        raise IOError(f"cannot open '{filename}'")
+    layer = source.GetLayer()
+    reference = layer.GetSpatialRef()
+    transform = None
+    if reference is not None:
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(reference, get_lonlat())
+    geometries = []
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        if transform:
+            geometry.Transform(transform)
+        geometries.append(wkb.loads(bytes(geometry.ExportToWkb())))
+    del layer, source
+
+    return unary_union(geometries).buffer(0) if geometries else None
+
+
+class Coverage:
+    # Pre-download filter: the part of an area (or a shape) a snapshot
+    # footprint covers, with prepared geometries for the disjoint/contained
+    # cases. Fractions are of lon/lat areas, which is close enough for
+    # thresholds. Snapshots over max_cloud percent cloudy are skipped too
+    def __init__(self, min_area: float = 0.0, min_shapes: float = 0.0,
+            max_cloud: float = None) -> None:
+        self.min_area = min_area
+        self.min_shapes = min_shapes
+        self.max_cloud = max_cloud
+        self._geometries: Dict[str, Tuple[Any, Any]] = {}
+
+    @classmethod
+    def from_options(cls, options: Dict[str, Any]) -> 'Coverage':
+        if not options or not options.get('enable', False):
+            return None
+
+        return cls(options.get('min_area', 0.0),
+                   options.get('min_shapes', 0.0),
+                   options.get('max_cloud', None))
+
+    def get_geometry(self, key: str, read: Any) -> Tuple[Any, Any]:
+        # (geometry, prepared) by area WKT or shapefile name
+        if key not in self._geometries:
+            try:
+                geometry = read(key)
+            except Exception as e:
+                print(f"WARNING: no coverage for '{key[:64]}' ({e})")
+                geometry = None
+            self._geometries[key] = (geometry, prep(geometry)
+                                     if geometry is not None else None)
+
+        return self._geometries[key]
+
+    @staticmethod
+    def fraction(geometry: Any, prepared: Any, footprint: Any) -> float:
+        if not prepared.intersects(footprint):
+            return 0.0
+        if geometry.area == 0:
+            return 1.0 # points and lines are covered or not
+        if prep(footprint).contains(geometry):
+            return 1.0
+
+        return geometry.intersection(footprint).area / geometry.area
+
+    def select(self, snapshot: Any, area: str, shapes: List[str]
+            ) -> Tuple[List[str], List[str]]:
+        # Shapes worth processing and skipped shapes (None stands for the
+        # whole area, as in the shape lists of main())
+        footprint = snapshot.polygon
+        if footprint is None:
+            return list(shapes), []
+        if (self.max_cloud is not None and snapshot.cloud_coverage is not None
+                and snapshot.cloud_coverage > self.max_cloud):
+            return [], list(shapes)
+        geometry, prepared = self.get_geometry(area, wkt.loads)
+        if (geometry is not None
+                and self.fraction(geometry, prepared, footprint)
+                    < self.min_area):
+            return [], list(shapes)
+        kept: List[str] = []
+        skipped: List[str] = []
+        for shape in shapes:
+            if shape:
+                geometry, prepared = self.get_geometry(shape, read_shapes)
+                if (geometry is not None
+                        and self.fraction(geometry, prepared, footprint)
+                            < self.min_shapes):
+                    skipped.append(shape)
+                    continue
+            kept.append(shape)
+
+        return kept, skipped
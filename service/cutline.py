@@ -0,0 +1,237 @@
+import os
+import hashlib
+import threading
+import numpy as np
+
+from dataclasses import dataclass
+from osgeo import gdal, ogr, osr
+from typing import Dict, Tuple
+
+
+# Shapefile members a cutline depends on
+SHAPE_MEMBERS: Tuple[str, ...] = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+
+@dataclass
+class Cutline:
+    wkt: str # geometry in the target SRS
+    envelope: Tuple[float, float, float, float] # min x, min y, max x, max y
+    bounds: Tuple[float, float, float, float] # output bounds on the grid
+    mask: np.ndarray # uint8, 1 inside (rows, columns of the output)
+
+
+def get_digest(shape: str) -> str:
+    # Content hash of the shapefile members
+    digest = hashlib.sha1()
+    base = os.path.splitext(shape)[0]
+    for extension in SHAPE_MEMBERS:
+        try:
+            with open(base + extension, 'rb') as f:
+                for chunk in iter(lambda: f.read(1048576), b''):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            continue
+        digest.update(extension.encode())
+
+    return digest.hexdigest()
+
+
+def rasterize(geometry: ogr.Geometry, reference: osr.SpatialReference,
+        bounds: Tuple[float, float, float, float], resolution: float
+    ) -> np.ndarray:
+    # Mask of the output pixels whose centres are inside (as a GDAL warp
+    # cutline without CUTLINE_ALL_TOUCHED)
+    min_x, min_y, max_x, max_y = bounds
+    columns = max(1, int((max_x - min_x) / resolution + 0.5))
+    rows = max(1, int((max_y - min_y) / resolution + 0.5))
+    target = gdal.GetDriverByName('MEM').Create('', columns, rows, 1,
+                                                gdal.GDT_Byte)
+    target.SetGeoTransform((min_x, resolution, 0, max_y, 0, -resolution))
+    target.SetProjection(reference.ExportToWkt())
+    source = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = source.CreateLayer('cutline', reference)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+    gdal.RasterizeLayer(target, [1], layer, burn_values=[1])
+    mask = target.GetRasterBand(1).ReadAsArray()
+    del feature, layer, source, target
+
+    return mask
+
+
+class CutlineCache:
+    # Cutlines prepared once per (shapefile content, target grid): geometry
+    # reprojected to the target SRS, its envelope, the output bounds and the
+    # rasterized mask. Kept in memory and, with a path, on disk (shared by
+    # worker processes and cycles); a changed shapefile gets a new key
+    def __init__(self, path: str = None) -> None:
+        self.path = path
+        self._cutlines: Dict[str, Cutline] = {}
+        self._digests: Dict[Tuple[str, Tuple], str] = {}
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def get(self, shape: str, srs: str, resolution: float,
+            aligned: bool = False,
+            origin: Tuple[float, float] = None) -> Cutline:
+        # aligned: bounds snapped to the resolution (as targetAlignedPixels),
+        # origin: snapped to the pixel grid of a source with that top left
+        # corner (a pure crop), else whole pixels from the shape envelope
+        if aligned:
+            origin = (0.0, 0.0)
+        if origin is not None:
+            origin = (origin[0] % resolution, origin[1] % resolution)
+            grid = f"grid{origin[0]:.6g},{origin[1]:.6g}"
+        else:
+            grid = 'crop'
+        key = '_'.join([self._digest(shape),
+                        hashlib.sha1(srs.encode()).hexdigest()[:8],
+                        f"{resolution:g}", grid])
+        with self._lock:
+            if key in self._cutlines:
+                return self._cutlines[key]
+        cutline = self._load(key)
+        if cutline is None:
+            cutline = self._prepare(shape, srs, resolution, origin)
+            self._save(key, cutline)
+        with self._lock:
+            self._cutlines[key] = cutline
+
+        return cutline
+
+    def _digest(self, shape: str) -> str:
+        # Rehash only when a member's size or mtime changes
+        signature = []
+        base = os.path.splitext(shape)[0]
+        for extension in SHAPE_MEMBERS:
+            try:
+                stat = os.stat(base + extension)
+                signature.append((extension, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                continue
+        memo = (os.path.abspath(shape), tuple(signature))
+        with self._lock:
+            digest = self._digests.get(memo)
+        if digest is None:
+            digest = get_digest(shape)
+            with self._lock:
+                self._digests[memo] = digest
+
+        return digest
+
+    @staticmethod
+    def _prepare(shape: str, srs: str, resolution: float,
+            origin: Tuple[float, float]) -> Cutline:
+        reference = osr.SpatialReference()
+        reference.SetFromUserInput(srs)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        source = ogr.Open(shape)
+        if source is None:
+            raise IOError(f"cannot open '{shape}'")
+        layer = source.GetLayer()
+        transform = None
+        if layer.GetSpatialRef() is not None:
+            layer_reference = layer.GetSpatialRef().Clone()
+            if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+                layer_reference.SetAxisMappingStrategy(
+                    osr.OAMS_TRADITIONAL_GIS_ORDER
+                )
+            transform = osr.CoordinateTransformation(layer_reference,
+                                                     reference)
+        geometry = ogr.Geometry(ogr.wkbMultiPolygon)
+        for feature in layer:
+            part = feature.GetGeometryRef()
+            if part is None:
+                continue
+            part = part.Clone()
+            if transform:
+                part.Transform(transform)
+            geometry = geometry.Union(part)
+        del layer, source
+        if geometry.IsEmpty():
+            raise ValueError(f"no geometry in '{shape}'")
+        min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+        envelope = (min_x, min_y, max_x, max_y)
+        if origin is not None:
+            # Output bounds snapped outwards onto the grid
+            origin_x, origin_y = origin
+            bounds = (origin_x + np.floor((min_x - origin_x) / resolution)
+                                 * resolution,
+                      origin_y + np.floor((min_y - origin_y) / resolution)
+                                 * resolution,
+                      origin_x + np.ceil((max_x - origin_x) / resolution)
+                                 * resolution,
+                      origin_y + np.ceil((max_y - origin_y) / resolution)
+                                 * resolution)
+        else:
+            # Whole pixels from the top left corner (as cropToCutline with
+            # a target resolution), so mask and warp share one grid
+            columns = max(1, int((max_x - min_x) / resolution + 0.5))
+            rows = max(1, int((max_y - min_y) / resolution + 0.5))
+            bounds = (min_x, max_y - rows * resolution,
+                      min_x + columns * resolution, max_y)
+        mask = rasterize(geometry, reference, bounds, resolution)
+
+        return Cutline(geometry.ExportToWkt(), envelope,
+                       tuple(float(value) for value in bounds), mask)
+
+    def _load(self, key: str) -> Cutline:
+        if not self.path:
+            return None
+        filename = os.path.join(self.path, f"{key}.npz")
+        try:
+            with np.load(filename) as data:
+                return Cutline(str(data['wkt']),
+                               tuple(data['envelope'].tolist()),
+                               tuple(data['bounds'].tolist()),
+                               data['mask'])
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"WARNING: bad cutline '{filename}' ({e})")
+
+        return None
+
+    def _save(self, key: str, cutline: Cutline) -> None:
+        if not self.path:
+            return None
+        filename = os.path.join(self.path, f"{key}.npz")
+        temp = os.path.join(self.path, f"{key}.{os.getpid()}.tmp.npz")
+        np.savez_compressed(temp, wkt=np.array(cutline.wkt),
+                            envelope=np.array(cutline.envelope),
+                            bounds=np.array(cutline.bounds),
+                            mask=cutline.mask)
+        os.replace(temp, filename)
+
+        return None
+
+
+def warp_cutline(destination: str, source: gdal.Dataset, cutline: Cutline,
+        options_warp: dict, **kwargs
+    ) -> str:
+    # Warp to the cutline bounds in memory, clear the pixels outside the
+    # cached mask and write the file (no cutline parsing or rasterizing)
+    options = dict(options_warp, **kwargs)
+    creation = options.pop('creationOptions', None) or []
+    driver = gdal.GetDriverByName(options.pop('format', 'GTiff'))
+    options.pop('targetAlignedPixels', None) # bounds are snapped already
+    rows, columns = cutline.mask.shape
+    options.update(format='MEM', outputBounds=cutline.bounds,
+                   width=columns, height=rows)
+    options.pop('xRes', None)
+    options.pop('yRes', None)
+    memoset = gdal.Warp('', source, **options)
+    outside = cutline.mask == 0
+    for i in range(memoset.RasterCount):
+        band = memoset.GetRasterBand(i + 1)
+        image = band.ReadAsArray()
+        image[outside] = 0
+        band.WriteArray(image)
+        del band
+    driver.CreateCopy(destination, memoset, 0, creation)
+    del memoset
+
+    return destination
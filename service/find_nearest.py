@@ -1,44 +1,88 @@
+import os
 import json
+import argparse
 import datetime
-from itertools import product
 
+from typing import Any, Dict
+
+from sentinel import Catalog
 from sentinel import Config
 from sentinel import DataHub
 from sentinel import Filters
 from sentinel import Polygons
+from sentinel import match_nearest
+
+
+def get_params(search: Dict[str, Any], **params: Any) -> Dict[str, Any]:
+    # A copy of the config search section, keys overridden case-insensitively
+    names = {k.lower() for k in params}
+    query = {k: v for k, v in (search or {}).items()
+             if k.lower() not in names}
+    query.update(params)
+
+    return query
 
 
-def find_nearest() -> None:
+def find_nearest(k: int = 1, max_delta: datetime.timedelta = None,
+        intersects: bool = False) -> None:
     config = Config.load('config.yaml')
     data_hub = DataHub(config, limit=1000)
+    if config.cache and config.cache.get('catalog'):
+        catalog = Catalog(config.cache['catalog'], config.verbose)
+        if os.getenv('GPS_OFFLINE', '').lower() in ['1', 'y', 'on', 'yes',
+                                                   'true']:
+            data_hub = catalog # answer from the local catalog only
+        else:
+            data_hub.catalog = catalog
 
-    params = config.search
-    params['footprint'] = f"\"Intersects({Polygons.greenland_west})\""
-    params['cloudCoverPercentage'] = "[0 TO 50]"
-    params.update(Filters.rgb)
+    footprint = f"\"Intersects({Polygons.greenland_west})\""
+    params = get_params(config.search, footprint=footprint,
+                        cloudCoverPercentage="[0 TO 50]", **Filters.rgb)
     snapshots_rgb = data_hub.search(params)
     if not snapshots_rgb:
         print("No RGB data found!")
         return None
 
-    params = config.search
-    params['footprint'] = f"\"Intersects({polygons.greenland_west})\""
-    params.update(Filters.radar)
+    params = get_params(config.search, footprint=footprint, **Filters.radar)
     snapshots_radar = data_hub.search(params)
     if not snapshots_radar:
         print("No radar data found!")
         return None
 
-    nearest = min(
-        product(snapshots_rgb, snapshots_radar),
-        key=lambda t: abs(t[0].begin_position - t[1].begin_position)
-    )
+    pairs = match_nearest(snapshots_rgb, snapshots_radar, k=k,
+                          max_delta=max_delta, intersects=intersects)
+    if not pairs:
+        print("No pairs found!")
+        return None
 
     print("\n=== Min time difference ===")
-    print(abs(nearest[0].begin_position - nearest[1].begin_position))
-    print(f"\n{nearest[0]}\n{nearest[1]}")
+    print(pairs[0][2])
+    print(f"\n{pairs[0][0]}\n{pairs[0][1]}")
+    if len(pairs) > 1:
+        print(f"\n=== {len(pairs)} pairs ===")
+        for rgb, radar, delta in pairs:
+            print(f"{delta}  {rgb.title}  {radar.title}")
 
     return None
 
 if __name__ == '__main__':
-    find_nearest()
+    parser = argparse.ArgumentParser(description='GPS nearest RGB/radar '
+                                                 'snapshot pairs')
+    parser.add_argument('-k', '--nearest', default=None, type=int,
+                        help='number of nearest pairs (default 1, or all '
+                             'within --max-delta)')
+    parser.add_argument('-d', '--max-delta', default=None, type=float,
+                        help='max time difference of a pair (hours)')
+    parser.add_argument('-i', '--intersects', action='store_true',
+                        help='pair only snapshots with intersecting '
+                             'footprints')
+
+    args = parser.parse_args()
+
+    if args.max_delta is not None:
+        max_delta = datetime.timedelta(hours=args.max_delta)
+        k = args.nearest
+    else:
+        max_delta = None
+        k = args.nearest or 1
+    find_nearest(k, max_delta, args.intersects)
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import threading
+
+from transfer import Transfer
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+
+Unit = Tuple[str, str, str, str] # (set, area, snapshot UUID, shape)
+
+
+class Journal:
+    # Durable work journal: one JSON line per state change of a unit
+    # (set, area, snapshot UUID, shape), a file per input set. The latest
+    # record of a unit wins; 'done' (and 'skipped') units are never fetched
+    # or warped again. Optionally mirrored to S3 ('<prefix>/<set>.jsonl') for
+    # hosts without persistent disk: changed files are uploaded by sync()
+    # (once per published snapshot and when a set is finished), not on
+    # every record
+    def __init__(self, path: str, transfer: Transfer = None,
+            prefix: str = None) -> None:
+        self.path = path
+        self.transfer = transfer # shared by pipeline workers
+        self.prefix = prefix
+        self._units: Dict[str, Dict[Unit, Dict[str, Any]]] = {}
+        self._changed: Set[str] = set() # sets not mirrored yet
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def name(path: str) -> str:
+        # Area/shape key: file name without extension ('' for no shape)
+        return os.path.splitext(os.path.basename(path))[0] if path else ''
+
+    def known(self, name: str) -> bool:
+        return bool(self._load(name))
+
+    def finished(self, name: str) -> bool:
+        record = self._load(name).get((name, '', '', ''))
+        return bool(record) and record['state'] == 'done'
+
+    def produced(self, name: str) -> bool:
+        # Any unit of the set output (skipped ones are not)
+        return any(record['state'] == 'done' and unit[2]
+                   for unit, record in self._load(name).items())
+
+    def done(self, name: str, area: str, uuid: str, shape: str) -> bool:
+        unit = (name, self.name(area), uuid, self.name(shape))
+        record = self._load(name).get(unit)
+        return bool(record) and record['state'] in ('done', 'skipped')
+
+    def pending(self, name: str, area: str, uuid: str,
+            shapes: List[str]) -> List[str]:
+        return [shape for shape in shapes
+                if not self.done(name, area, uuid, shape)]
+
+    def mark(self, name: str, area: str, uuid: str, shape: str,
+            state: str, products: List[str] = None) -> None:
+        unit = (name, self.name(area), uuid, self.name(shape))
+        self._write(name, unit, state, products)
+
+        return None
+
+    def finish(self, name: str) -> None:
+        self._write(name, (name, '', '', ''), 'done')
+        self.sync([name])
+
+        return None
+
+    def sync(self, names: Iterable[str] = None) -> None:
+        # Mirror the changed journals (of the given sets, or all) to S3,
+        # outside the lock: a torn last line is skipped on load
+        with self._lock:
+            names = set(self._changed if names is None else names)
+            names &= self._changed
+            self._changed -= names
+        if not self.transfer:
+            return None
+        for name in sorted(names):
+            try:
+                self.transfer.put(self._filename(name),
+                                  f"{self.prefix}/{name}.jsonl")
+            except Exception as e:
+                with self._lock:
+                    self._changed.add(name) # retried by the next sync
+                print(f"WARNING: journal '{name}' not mirrored ({e})")
+
+        return None
+
+    def _filename(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.jsonl")
+
+    def _load(self, name: str) -> Dict[Unit, Dict[str, Any]]:
+        with self._lock:
+            if name in self._units:
+                return self._units[name]
+            filename = self._filename(name)
+            if not os.path.exists(filename) and self.transfer:
+                try:
+                    if self.transfer.ls(f"{self.prefix}/{name}.jsonl"):
+                        self.transfer.get(f"{self.prefix}/{name}.jsonl",
+                                          filename)
+                except Exception as e:
+                    print(f"WARNING: journal '{name}' not fetched ({e})")
+            units = {}
+            if os.path.exists(filename):
+                with open(filename) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue # torn last line
+                        unit = (record['set'], record['area'],
+                                record['uuid'], record['shape'])
+                        units[unit] = record
+            self._units[name] = units
+
+            return units
+
+    def _write(self, name: str, unit: Unit, state: str,
+            products: List[str] = None) -> None:
+        units = self._load(name)
+        record = {'set': unit[0], 'area': unit[1], 'uuid': unit[2],
+                  'shape': unit[3], 'state': state,
+                  'products': products or [], 'time': time.time()}
+        with self._lock:
+            units[unit] = record
+            filename = self._filename(name)
+            with open(filename, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._changed.add(name)
+
+        return None
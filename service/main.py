@@ -1,7 +1,6 @@
 import sys
 
 import os
-import zipfile
 import tempfile
 import sched, time
 import numpy as np
@@ -11,17 +10,41 @@ from glob import glob
 from osgeo import gdal
 from shutil import rmtree
 from subprocess import Popen, PIPE, STDOUT
-from typing import Any, List, Tuple, Set
+from typing import Any, Dict, List, Tuple, Set
 
+from sentinel import BatchSearch
+from sentinel import Catalog
 from sentinel import Config
 from sentinel import DataHub
+from sentinel import DeltaSearch
 from sentinel import Polygons
+from sentinel import SnapshotTable
+from pipeline import Pipeline, ProcessPool
+from transfer import Transfer
+from cache import MiB, ProductCache
+from coverage import Coverage
+from cutline import CutlineCache, warp_cutline
+from journal import Journal
+from raster import BLOCK_PIXELS
+from raster import compose_sentinel1_blocks, copy_georeference, locate_safe
+from raster import compose_sentinel1_arrays, stretch_bands
+from raster import crop_window, plan_window, select_bands, warp_to_grid
+from stats import Stats, StatsProvider
 from utils import get_environment, print_snapshots, remove
 
 
 # Main loop period (seconds)
 INTERVAL: int = 10#0
 
+# Local product cache (see get_cache)
+_cache: ProductCache = None
+
+# Prepared cutlines (see get_cutlines)
+_cutlines: CutlineCache = None
+
+# Band statistics of the stretches (see get_stats)
+_stats: StatsProvider = None
+
 
 def check_in_aws(s3: B3W, prefix: str, depth: int = 1) -> Set[str]:
     objects: Set[str] = set() #List[str] = []
@@ -40,9 +63,10 @@ def check_in_aws(s3: B3W, prefix: str, depth: int = 1) -> Set[str]:
 
 
 def get_from_aws(s3: B3W, prefix: str,
-        path: str = '/dev/shm/gps/input'
+        path: str = '/dev/shm/gps/input', transfer: Transfer = None
     ) -> List[str]:
     files: List[str] = []
+    pairs: List[Tuple[str, str]] = []
     try:
         #objects = s3.ls(prefix)
         #print(f"DEBUG: objects = {objects}")
@@ -59,8 +83,13 @@ def get_from_aws(s3: B3W, prefix: str,
             filename = os.path.join(path, *filename.split('/'))
             #print(f"DEBUG: {s3o} -> {filename}")
             os.makedirs(os.path.dirname(filename), exist_ok=True)
-            s3.get(s3o, filename)
+            pairs.append((s3o, filename))
             files.append(filename)
+        if transfer:
+            transfer.get_many(pairs)
+        else:
+            for s3o, filename in pairs:
+                s3.get(s3o, filename)
     except Exception as e:
         #TODO: debug and handle different kinds of exceptions
         raise e
@@ -69,12 +98,20 @@ def get_from_aws(s3: B3W, prefix: str,
 
 
 def put_to_aws(s3: B3W, prefix: str,
-        path: str = '/dev/shm/gps/output'
+        path: str = '/dev/shm/gps/output', files: List[str] = None,
+        manifest: Dict[str, Tuple[int, int]] = None,
+        transfer: Transfer = None
     ) -> List[str]:
+    # Upload the given files (or the whole path), skipping objects the
+    # manifest (S3 key -> size, mtime) has already seen unchanged
     objects: List[str] = []
+    pairs: List[Tuple[str, str]] = []
+    signatures: Dict[str, Tuple[int, int]] = {}
     try:
         path = os.path.normpath(path)
-        for filename in glob(os.path.join(path, '**'),  recursive=True):
+        if files is None:
+            files = glob(os.path.join(path, '**'),  recursive=True)
+        for filename in files:
             if not os.path.isfile(filename):
                 continue
             s3o = os.path.relpath(filename, path)
@@ -82,8 +119,21 @@ def put_to_aws(s3: B3W, prefix: str,
                 s3o = '/'.join([prefix.strip('/'), *s3o.split(os.path.sep)])
             else:
                 s3o = '/'.join([*s3o.split(os.path.sep)])
+            stat = os.stat(filename)
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if manifest is not None and manifest.get(s3o) == signature:
+                continue
             #print(f"DEBUG: '{filename}' -> '{s3o}'")
-            s3.put(filename, s3o, force=True)
+            pairs.append((filename, s3o))
+            signatures[s3o] = signature
+            objects.append(s3o)
+        if transfer:
+            transfer.put_many(pairs)
+        else:
+            for filename, s3o in pairs:
+                s3.put(filename, s3o, force=True)
+        if manifest is not None:
+            manifest.update(signatures)
     except Exception as e:
         #TODO: debug and handle different kinds of exceptions
         raise e
@@ -109,13 +159,24 @@ def remove_from_aws(s3: B3W, prefix: str) -> List[str]:
 
 def sync_with_aws(
         s3: B3W, prefix: str, data_hub: DataHub,
-        snapshot: Any, path: str = '/dev/shm/gps/data'
+        snapshot: Any, path: str = '/dev/shm/gps/data',
+        transfer: Transfer = None, cache: ProductCache = None
     ) -> str:
     filename: str = None
+    if cache:
+        # Cached products are pinned until the caller unpins them
+        filename = cache.get(snapshot.uuid, pin=True)
+        if filename:
+            print(f"DEBUG: cached '{snapshot.uuid}' -> '{filename}'")
+            return filename
+    # Hub downloads go to the cache (persistent, so a partial download
+    # resumes next cycle and the product needs no move when finished)
+    root = cache.root if cache else path
     try:
-        data_hub.config.output = os.path.join(path, snapshot.uuid)
-        os.makedirs(data_hub.config.output, exist_ok=True)
-        objects = s3.ls('/'.join([prefix, snapshot.uuid]))
+        output = os.path.join(root, snapshot.uuid)
+        os.makedirs(output, exist_ok=True)
+        # Pipeline workers list through the (thread-safe) transfer client
+        objects = (transfer or s3).ls('/'.join([prefix, snapshot.uuid]))
         print(f"DEBUG: S3 objects = {objects}")
         #if len(objects) > 0:
         for s3o in objects:
@@ -124,26 +185,36 @@ def sync_with_aws(
                 continue
             filename = os.path.join(path, s3o.replace(prefix, '').lstrip('/'))
             print(f"DEBUG: syncing '{s3o}' -> '{filename}'")
-            s3.get(s3o, filename)
+            if transfer:
+                transfer.get(s3o, filename)
+            else:
+                s3.get(s3o, filename)
             break
         if not filename:
-            data_hub.download(snapshot)
-            #print(f"DEBUG: data_hub.config.output = {data_hub.config.output}")
-            for filename in glob(os.path.join(data_hub.config.output, '*')):
+            data_hub.download(snapshot, output=output)
+            # Skip unfinished segmented downloads ('.part' and its journal)
+            downloaded = [filename
+                          for filename in glob(os.path.join(output, '*'))
+                          if not filename.endswith(('.part', '.part.json'))]
+            for filename in downloaded:
             #print(f"DEBUG: filename = {filename}")
             #if len(filename) < 1:
             #    raise FileNotFoundError(f"failed to download {snapshot.uuid}!")
             #else:
             #    filename = filename[0]
-                s3o = filename.replace(path, '').lstrip(os.path.sep)
+                s3o = filename.replace(root, '').lstrip(os.path.sep)
                 # TODO: check filename against snapshot.uuid
                 s3o = '/'.join([prefix, s3o])
                 print(f"DEBUG: syncing '{filename}' -> '{s3o}'")
-                s3.put(filename, s3o)
+                if transfer:
+                    transfer.put(filename, s3o)
+                else:
+                    s3.put(filename, s3o)
                 break
             if not filename:
                 print(f"failed to download {snapshot.uuid}!")
-        data_hub.config.output = None # TODO: devise something smart
+        if cache and filename:
+            filename = cache.put(snapshot.uuid, filename, pin=True)
     except FileNotFoundError as e:
         print(f"Failure: {e}")
     except Exception as e:
@@ -153,6 +224,81 @@ def sync_with_aws(
     return filename
 
 
+def clean_data(path: str) -> None:
+    # Remove the data directory but unfinished segmented downloads ('.part'
+    # and its journal), so these resume next cycle
+    try:
+        products = os.listdir(path)
+    except FileNotFoundError:
+        return None
+    for uuid in products:
+        output = os.path.join(path, uuid)
+        if not os.path.isdir(output):
+            os.remove(output)
+            continue
+        filenames = os.listdir(output)
+        if not any(filename.endswith('.part.json') for filename in filenames):
+            rmtree(output, ignore_errors=True)
+            continue
+        for filename in filenames:
+            if filename.endswith(('.part', '.part.json')):
+                continue
+            filename = os.path.join(output, filename)
+            if os.path.isdir(filename):
+                rmtree(filename, ignore_errors=True)
+            else:
+                os.remove(filename)
+
+    return None
+
+
+def get_cache(options: Dict[str, Any]) -> ProductCache:
+    # Product cache persists between cycles (once per daemon)
+    global _cache
+    if not options or not options.get('path'):
+        return None
+    if _cache is None or _cache.root != options['path']:
+        _cache = ProductCache(options['path'],
+                              options.get('size', 20480) * MiB)
+    else:
+        _cache.budget = options.get('size', 20480) * MiB
+
+    return _cache
+
+
+def get_cutlines(options: Dict[str, Any]) -> CutlineCache:
+    # Cutline cache persists between snapshots (once per process)
+    global _cutlines
+    if not options or not options.get('enable', False):
+        return None
+    if _cutlines is None or _cutlines.path != options.get('path'):
+        _cutlines = CutlineCache(options.get('path'))
+
+    return _cutlines
+
+
+def get_stats(options: Dict[str, Any]) -> StatsProvider:
+    # Statistics provider persists between snapshots (once per process)
+    global _stats
+    stats = StatsProvider.from_options(options)
+    if stats is None:
+        return None
+    if _stats is None or _stats.settings != stats.settings:
+        _stats = stats
+
+    return _stats
+
+
+def get_band_stats(stats: StatsProvider, dataset: gdal.Dataset, index: int,
+        product: str, name: str, nodata: float = None) -> Stats:
+    result = stats.get(dataset.GetRasterBand(index), product, name, nodata)
+    print(f"Statistics of {name} ({result.mode}): mean {result.mean:g}",
+          f"± {result.error_mean:.3g}, std {result.std:g}",
+          f"± {result.error_std:.3g} from {result.count:,} pixels")
+
+    return result
+
+
 def set_debug_aws() -> None:
     s3_id, s3_key, s3_bucket, s3_input, s3_output, s3_sync = get_environment()
     path_input, path_output = ('/dev/shm/gps/input', '/dev/shm/gps/output')
@@ -178,8 +324,29 @@ def set_debug_aws() -> None:
     return None
 
 
-def process_sentinel1(filename, path_output, area, shapes):
+def compose_sentinel1_memory(source: gdal.Dataset,
+        clips: Tuple[np.float32, np.float32] = None) -> gdal.Dataset:
+    # Basic RGB processing (whole scene in memory, fused kernel)
+    image_hh = source.GetRasterBand(1).ReadAsArray()
+    image_hv = source.GetRasterBand(2).ReadAsArray()
+    images = compose_sentinel1_arrays(image_hh, image_hv, clips)
+    del image_hh, image_hv
+    # Write channels to the MEM dataset (HH, HV, HH/HV, 1 - HH/HV)
+    memoset = gdal.GetDriverByName('MEM').Create('', source.RasterXSize,
+                                                 source.RasterYSize, 4,
+                                                 gdal.GDT_Byte)
+    copy_georeference(source, memoset)
+    for i, image in enumerate(images):
+        memoset.GetRasterBand(i + 1).WriteArray(image)
+    del images
+
+    return memoset
+
+
+def process_sentinel1(filename, targets, processing=None):
+    # Targets: (output path, area, shapes) cut from the same composite
     title = os.path.splitext(os.path.basename(filename))[0]
+    processing = processing or {}
     options_warp = {
             'format': 'GTiff',
             'dstSRS': 'EPSG:32640',
@@ -187,114 +354,123 @@ def process_sentinel1(filename, path_output, area, shapes):
             'xRes': 40,
             'yRes': 40
     }
+    # Warp each layer once and crop the shapes from the reprojection
+    outputs = sum(len(shapes) for _, _, shapes in targets)
+    warp_once = processing.get('warp_once', False) and outputs > 1
+    # Warp only the source window a shape covers, skip shapes off the scene
+    crop_source = processing.get('crop_source', False)
+    cutlines = get_cutlines(processing.get('cutlines', None))
+    stats = get_stats(processing.get('stats', None))
+    streaming = processing.get('streaming', False)
+    if warp_once:
+        options_warp['targetAlignedPixels'] = True
     with tempfile.TemporaryDirectory() as path_temp:
-        with zipfile.ZipFile(filename, 'r') as archive:
-            archive.extractall(path_temp)
-            path_safe = glob(os.path.join(path_temp, f"*.SAFE"))[0]
-            dataset = gdal.Open(path_safe, gdal.GA_ReadOnly)
-            subsets = dataset.GetSubDatasets()
-            datasets = {}
-            for i, p in enumerate(['HH', 'HV', 'RGB']):
-                print(f"Reading {subsets[i][1]}...")
-                datasets[p] = gdal.Open(subsets[i][0], gdal.GA_ReadOnly)
-            filenames = []
-            name_area = os.path.splitext(os.path.basename(area))[0]
-            print(f"Warping polarizations...")
-            for name, source in datasets.items():
+        # Read the SAFE in place (/vsizip/), extract the needed members or the
+        # whole archive
+        path_safe = locate_safe(filename, path_temp,
+                                processing.get('safe_access', 'extract'))
+        dataset = gdal.Open(path_safe, gdal.GA_ReadOnly)
+        subsets = dataset.GetSubDatasets()
+        datasets = {}
+        for i, p in enumerate(['HH', 'HV', 'RGB']):
+            print(f"Reading {subsets[i][1]}...")
+            datasets[p] = gdal.Open(subsets[i][0], gdal.GA_ReadOnly)
+        filenames = []
+        print(f"Warping polarizations...")
+        for name, source in datasets.items():
+            if name in ['RGB', 'INV']:
+                # Compose once per product, then cut for every shape
+                clips = None
+                if stats and (streaming or stats.mode != 'exact'):
+                    # Exact clips in memory come with the composing pass
+                    clips = tuple(get_band_stats(stats, source, i + 1, title,
+                                                 p, 0).clip()
+                                  for i, p in enumerate(['HH', 'HV']))
+                if streaming:
+                    print(f"Composing {name} by blocks...")
+                    composite = compose_sentinel1_blocks(
+                        source, os.path.join(path_temp, 'composite.tiff'),
+                        processing.get('block_pixels', BLOCK_PIXELS), clips
+                    )
+                else:
+                    composite = compose_sentinel1_memory(source, clips)
+                # Create ratio (HH, HV, HH/HV) and negative
+                # (HH, HV, 1 - HH/HV) images
+                layers = {
+                    'ratio': select_bands(composite, (1, 2, 3),
+                                          {'POLARISATION': 'HH/HV',
+                                           'SWATH': 'EW'}),
+                    'negative': select_bands(composite, (1, 2, 4),
+                                             {'POLARISATION': '1 - HH/HV',
+                                              'SWATH': 'EW'})
+                }
+                options_type = {'outputType': gdal.GDT_Byte}
+            else:
+                layers = {name.lower(): source}
+                options_type = {}
+            for layer, view in layers.items():
+                if warp_once:
+                    # Reproject once, then only crop for every shape
+                    print(f"Warping {layer}...")
+                    path_warped = os.path.join(path_temp,
+                                               f"warped_{layer}.tiff")
+                    view = warp_to_grid(view, path_warped, options_warp,
+                                        **options_type)
                 #
                 # Prepare filenames and paths
                 #
-                for shape in shapes:
-                    if shape:
-                        name_shape = os.path.basename(shape)
-                        name_shape = os.path.splitext(name_shape)[0]
-                        data_prefix = f"{name_area}_{name_shape}"
-                        options_cutline = {'cutlineDSName': shape,
-                                           'cropToCutline': True}
-                    else:
-                        data_prefix = f"{name_area}"
-                        options_cutline = {}
-                    data_output = os.path.join(path_output, data_prefix)
-                    if not name in ['RGB', 'INV']:
-                        data_output = os.path.join(data_output, name.lower())
+                for path_output, area, shapes in targets:
+                    name_area = os.path.splitext(os.path.basename(area))[0]
+                    for shape in shapes:
+                        source = view
+                        if shape:
+                            name_shape = os.path.basename(shape)
+                            name_shape = os.path.splitext(name_shape)[0]
+                            data_prefix = f"{name_area}_{name_shape}"
+                            options_cutline = {'cutlineDSName': shape,
+                                               'cropToCutline': True}
+                            if crop_source:
+                                window = plan_window(view, shape)
+                                if window is None:
+                                    print(f"{name_shape} is off the scene")
+                                    continue
+                                source = crop_window(view, window)
+                        else:
+                            data_prefix = f"{name_area}"
+                            options_cutline = {}
+                        data_output = os.path.join(path_output, data_prefix,
+                                                   layer)
                         os.makedirs(data_output, exist_ok=True)
                         print(f"{data_output.replace(path_output, '')}")
-                        destination = f"{os.path.join(data_output, title)}.tiff"
-                        filenames.append(destination)
-                        gdal.Warp(destination, source, **options_warp,
-                                  **options_cutline)
-                    else:
-                        # Basic RGB processing
-                        driver_mem = gdal.GetDriverByName('MEM')
-                        memoset = driver_mem.CreateCopy('', source, 0)
-                        band_hh = memoset.GetRasterBand(1)
-                        image_hh = band_hh.ReadAsArray()
-                        mask_hh = image_hh == 0
-                        image_hh = np.ma.array(image_hh, mask=mask_hh,
-                                               dtype=np.float32)
-                        del mask_hh
-                        band_hv = memoset.GetRasterBand(2)
-                        image_hv = band_hv.ReadAsArray()
-                        mask_hv = image_hv == 0
-                        image_hv = np.ma.array(image_hv, mask=mask_hv,
-                                               dtype=np.float32)
-                        del mask_hv
-                        stats_hh = (image_hh.mean().astype(np.float32),
-                                    image_hh.std().astype(np.float32))
-                        stats_hv = (image_hv.mean().astype(np.float32),
-                                    image_hv.std().astype(np.float32))
-                        image_hh = np.ma.tanh(image_hh / (stats_hh[0] + 2 *
-                                                          stats_hh[1]))
-                        image_hv = np.ma.tanh(image_hv / (stats_hv[0] + 2 *
-                                                          stats_hv[1]))
-                        image_ratio = image_hh / image_hv
-                        stats_ratio = (image_ratio.mean().astype(np.float32),
-                                       image_ratio.std().astype(np.float32))
-                        image_ratio = image_ratio / image_ratio.max()
-                        image_negative = (np.float32(1) -
-                                          np.ma.tanh(image_hh / image_hv))
-                        # Convert to byte type
-                        image_hh = (image_hh * 254 + 1).astype(np.uint8)
-                        image_hv = (image_hv * 254 + 1).astype(np.uint8)
-                        image_ratio = (image_ratio * 254 + 1).astype(np.uint8)
-                        image_negative = (image_negative * 254 + 1)\
-                                         .astype(np.uint8)
-                        # Write channels to the MEM dataset
-                        memoset.AddBand()
-                        band_ex = memoset.GetRasterBand(3)
-                        band_ex.SetColorInterpretation(gdal.GCI_BlueBand)
-                        band_hh.WriteArray(image_hh)
-                        band_hh.SetColorInterpretation(gdal.GCI_RedBand)
-                        band_hv.WriteArray(image_hv)
-                        band_hv.SetColorInterpretation(gdal.GCI_GreenBand)
-                        # Create ratio band (HH, HV, HH/HV)
-                        band_ex.WriteArray(image_ratio)
-                        band_ex.SetMetadata({'POLARISATION': 'HH/HV',
-                                             'SWATH': 'EW'})
-                        path_ratio = os.path.join(data_output, 'ratio')
-                        os.makedirs(path_ratio, exist_ok=True)
-                        print(f"{path_ratio.replace(path_output, '')}")
-                        destination = f"{os.path.join(path_ratio, title)}.tiff"
-                        filenames.append(destination)
-                        gdal.Warp(destination, memoset, **options_warp,
-                                  outputType=gdal.GDT_Byte, **options_cutline)
-                        # Create negative band (HH, HV, 1 - HH/HV)
-                        band_ex.WriteArray(image_negative)
-                        band_ex.SetMetadata({'POLARISATION': '1 - HH/HV',
-                                             'SWATH': 'EW'})
-                        path_negative = os.path.join(data_output, 'negative')
-                        os.makedirs(path_negative, exist_ok=True)
-                        print(f"{path_negative.replace(path_output, '')}")
-                        destination = f"{os.path.join(path_negative, title)}.tiff"
+                        destination = os.path.join(data_output, title)
+                        destination = f"{destination}.tiff"
                         filenames.append(destination)
-                        gdal.Warp(destination, memoset, **options_warp,
-                                  outputType=gdal.GDT_Byte, **options_cutline)
+                        if cutlines and shape:
+                            # Reprojected geometry and mask prepared once
+                            cutline = cutlines.get(shape,
+                                                   options_warp['dstSRS'],
+                                                   options_warp['xRes'],
+                                                   warp_once)
+                            warp_cutline(destination, source, cutline,
+                                         options_warp, **options_type)
+                        else:
+                            gdal.Warp(destination, source, **options_warp,
+                                      **options_type, **options_cutline)
+                        del source
+                if warp_once:
+                    del view
+                    remove(path_warped)
+            del layers
+            if name in ['RGB', 'INV']:
+                del composite
     print(f"Done!")
     return filenames
 
 
-def process_sentinel2(filename, path_output, area, shapes):
+def process_sentinel2(filename, targets, processing=None):
+    # Targets: (output path, area, shapes) cut from the same stretch
     title = os.path.splitext(os.path.basename(filename))[0]
+    processing = processing or {}
     dataset = gdal.Open(filename, gdal.GA_ReadOnly)
     subsets = dataset.GetSubDatasets()
     assert len(subsets) > 0, f"no sub datasets found!"
@@ -302,60 +478,128 @@ def process_sentinel2(filename, path_output, area, shapes):
     #print(f"{snapshot.title} -->")
     print(f"Reading {subsets[0][1][:1].lower()}",
           f"{subsets[0][1][1:]}", sep='')
-    image = dataset.ReadAsArray()
-    if image.ndim < 3:
-        image = image[None, ...]
-    image = np.moveaxis(image[:3, ...], 0, -1) # CHW -> HWC
-    image = image.astype(np.float32)
+    count = min(dataset.RasterCount, 3)
+    # Approximate band means (the exact ones come with the bands read)
+    stats = get_stats(processing.get('stats', None))
+    means = None
+    if stats and stats.mode != 'exact':
+        means = [get_band_stats(stats, dataset, i + 1, title,
+                                f"band {i + 1}").mean
+                 for i in range(count)]
+    images = [dataset.GetRasterBand(i + 1).ReadAsArray()
+              for i in range(count)]
     print(f"Calculating optimal histogram...")
-    clip = image.mean().astype(np.float32) * np.float32(2)
-    image = image / clip
-    image = np.tanh(image)
-    # Apply gamma correction here (TODO)
-    image = (image * 254 + 1).round().astype(np.uint8)
+    options_stretch = processing.get('stretch', None) or {}
+    mode = options_stretch.get('mode', 'global')
+    gamma = options_stretch.get('gamma', None)
+    scale = options_stretch.get('scale', 2.0)
+    if all(image.dtype.kind == 'u' for image in images):
+        # Lookup table from the histogram: one gather per pixel
+        images = stretch_bands(images, mode, gamma, scale, means)
+    else:
+        # No lookup table for float (or signed) bands
+        pixels = sum(image.size for image in images)
+        if means is None:
+            means = [image.sum(dtype=np.float64) / image.size
+                     for image in images]
+        if mode == 'band':
+            clips = [np.float32(mean * scale) for mean in means]
+        else:
+            total = sum(mean * image.size
+                        for mean, image in zip(means, images))
+            clips = [np.float32(total / pixels * scale)] * len(images)
+        for i, (image, clip) in enumerate(zip(images, clips)):
+            image = np.tanh(image.astype(np.float32) / clip)
+            if gamma and gamma != 1:
+                np.power(image, np.float32(1 / gamma), out=image)
+            images[i] = (image * 254 + 1).round().astype(np.uint8)
+            del image
     # Apply nodata mask here (TODO)
-    image = np.moveaxis(image, -1, 0) # HWC -> CHW
     print(f"Applying histogram...")
-    tempset = gdal.GetDriverByName('MEM')\
-              .CreateCopy('', dataset, 0)
-    for i in range(image.shape[0]):
+    tempset = gdal.GetDriverByName('MEM').Create('', dataset.RasterXSize,
+                                                 dataset.RasterYSize, count,
+                                                 gdal.GDT_Byte)
+    copy_georeference(dataset, tempset)
+    colors = (gdal.GCI_RedBand, gdal.GCI_GreenBand, gdal.GCI_BlueBand)
+    for i, image in enumerate(images):
         band = tempset.GetRasterBand(i + 1)
-        band.WriteArray(image[i].astype(np.uint16))
+        if count == 3:
+            band.SetColorInterpretation(colors[i])
+        band.WriteArray(image)
         del band
+    del images
     print(f"Writing to temporary file...")
     with tempfile.TemporaryDirectory() as path_temp:
         temp = os.path.join(path_temp, 'temp.tiff')
         gdal.Translate(temp, tempset,
                        creationOptions=['COMPRESS=DEFLATE'],
-                       format='GTiff', bandList=[1, 2, 3],
+                       format='GTiff', bandList=list(range(1, count + 1)),
                        outputType=gdal.GDT_Byte)
         del tempset
         #
         # Prepare filenames and paths
         #
         filenames = []
-        name_area = os.path.splitext(os.path.basename(area))[0]
-        for shape in shapes:
-            if shape:
-                name_shape = os.path.basename(shape)
-                name_shape = os.path.splitext(name_shape)[0]
-                data_prefix = f"{name_area}_{name_shape}"
-                options = {'cutlineDSName': shape,
-                           'cropToCutline': True}
-            else:
-                data_prefix = f"{name_area}"
-                options = {}
-            data_output = os.path.join(path_output,
-                                       #data_name,
-                                       data_prefix)
-            os.makedirs(data_output, exist_ok=True)
-            destination = f"{os.path.join(data_output, title)}.tiff"
-            filenames.append(destination)
-            gdal.Warp(destination, temp, **options)
+        stretched = gdal.Open(temp, gdal.GA_ReadOnly)
+        cutlines = get_cutlines(processing.get('cutlines', None))
+        # Shapes are cropped on the source grid (SRS, pixel size, origin)
+        transform = stretched.GetGeoTransform()
+        grid = (stretched.GetProjection(), transform[1])
+        origin = (transform[0], transform[3])
+        for path_output, area, shapes in targets:
+            name_area = os.path.splitext(os.path.basename(area))[0]
+            for shape in shapes:
+                source = stretched
+                if shape:
+                    name_shape = os.path.basename(shape)
+                    name_shape = os.path.splitext(name_shape)[0]
+                    data_prefix = f"{name_area}_{name_shape}"
+                    options = {'cutlineDSName': shape,
+                               'cropToCutline': True}
+                    if processing.get('crop_source', False):
+                        # Warp only the window the shape covers
+                        window = plan_window(stretched, shape)
+                        if window is None:
+                            print(f"{name_shape} is off the scene")
+                            continue
+                        source = crop_window(stretched, window)
+                else:
+                    data_prefix = f"{name_area}"
+                    options = {}
+                data_output = os.path.join(path_output,
+                                           #data_name,
+                                           data_prefix)
+                os.makedirs(data_output, exist_ok=True)
+                destination = f"{os.path.join(data_output, title)}.tiff"
+                filenames.append(destination)
+                if cutlines and shape:
+                    cutline = cutlines.get(shape, *grid, origin=origin)
+                    warp_cutline(destination, source, cutline,
+                                 {'format': 'GTiff'})
+                else:
+                    gdal.Warp(destination, source, **options)
+                del source
+        del stretched
     print(f"Done!")
     return filenames
 
 
+def process_snapshot(platform: str, filename: str,
+        targets: List[Tuple[str, str, List[str]]], processing: dict = None
+    ) -> List[str]:
+    # Top level (picklable) to run in a worker process. The product is
+    # decoded once for all the (output path, area, shapes) targets
+    if platform == 'Sentinel-2':
+        filenames = process_sentinel2(filename, targets, processing)
+    elif platform == 'Sentinel-1':
+        filenames = process_sentinel1(filename, targets, processing)
+    else:
+        filenames = []
+        print(f"NOT IMPLEMENTED: {os.path.basename(filename)} {platform}")
+
+    return filenames
+
+
 def main(periodic: sched.scheduler) -> None:
     # Set working variables
     s3_id, s3_key, s3_bucket, s3_input, s3_output, s3_sync = get_environment()
@@ -364,9 +608,12 @@ def main(periodic: sched.scheduler) -> None:
 
     #print(f"\n=== Started input processing cycle ===\n")
     s3 = B3W(s3_bucket, s3_id, s3_key)
+    config = Config.load('config.yaml')
+    transfer = Transfer.from_b3w(s3, config.transfer)
+    cache = get_cache(config.cache)
 
     # Get input files from S3
-    files_input = get_from_aws(s3, s3_input, path_input)
+    files_input = get_from_aws(s3, s3_input, path_input, transfer)
     #print("DEBUG: input files -->")
     #print("\n".join([f"DEBUG: {filename}" for filename in files_input]))
     objects_output = check_in_aws(s3, s3_output, depth=1)
@@ -378,12 +625,46 @@ def main(periodic: sched.scheduler) -> None:
     #print("\n".join([f"DEBUG: {name}" for name in objects_sync]))
 
     # Initialize Copernicus Open Data Access Hub search object
-    config = Config.load('config.yaml')
     data_hub = DataHub(config, limit=1000)
-
-    # Cycle through all the data input sets: a set may contain multiple
-    # input areas and shapes to process. Result will be a snapshot that is
-    # cut with each shape (if any)
+    if config.cache and config.cache.get('catalog'):
+        # Keep every search result in the local catalog
+        data_hub.catalog = Catalog(config.cache['catalog'])
+    if config.cache and config.cache.get('searches'):
+        # Incremental (ingestion date) searches, state kept between cycles
+        searches = DeltaSearch(data_hub, config.cache['searches'])
+    else:
+        searches = None
+    options_pipeline = config.processing.get('pipeline', None) or {}
+    options_pool = config.processing.get('pool', None) or {}
+    if options_pool.get('enable', False):
+        max_rss = options_pool.get('max_rss', None)
+        pool = ProcessPool(options_pool.get('processes', None),
+                           options_pool.get('max_jobs', None),
+                           max_rss * 1048576 if max_rss else None)
+    else:
+        pool = None
+    if config.cache and config.cache.get('journal'):
+        # Processed units are journaled: interrupted sets resume where they
+        # stopped, completed (snapshot, shape) pairs are never redone
+        journal = Journal(config.cache['journal'],
+                          transfer if config.cache.get('journal_s3') else None,
+                          f"{s3_sync}/.journal")
+    else:
+        journal = None
+
+    def skip(data_name: str) -> bool:
+        if journal:
+            # Sets output before the journal existed are still skipped
+            return journal.finished(data_name) or (
+                data_name in objects_output
+                and not journal.known(data_name))
+
+        return data_name in objects_output
+
+    # Collect the data input sets: a set may contain multiple input areas and
+    # shapes to process. Result will be a snapshot that is cut with each
+    # shape (if any)
+    sets: Dict[str, Tuple[List[str], List[str]]] = {}
     for data_input in glob(os.path.join(path_input, '*')):
         if not os.path.isdir(data_input):
             #print(f"DEBUG: '{data_input}' is not a valid data input!")
@@ -391,7 +672,7 @@ def main(periodic: sched.scheduler) -> None:
             continue
         data_name = os.path.basename(data_input)
         #print(f"DEBUG: 'data_input' basename = {data_name}")
-        if data_name in objects_output:
+        if skip(data_name):
             #print(f"Output set for '{data_input}' already exists. Skipping...")
             continue
         #print(f"DEBUG: input directory --->\n{os.listdir(data_input)}\n")
@@ -400,82 +681,210 @@ def main(periodic: sched.scheduler) -> None:
         #print(f"DEBUG: shapes = {shapes}")
         if not shapes:
             shapes.append(None)
+        sets[data_name] = (areas, shapes)
+
+    # Search for the snapshots of every area
+    queries: List[Tuple[str, str, Dict[str, Any], str]] = []
+    incomplete: Set[str] = set() # sets with unread areas or cut searches
+    for data_name, (areas, shapes) in sets.items():
         for area in areas:
             try:
-                print(f"\n=== Processing '{area}' ===\n")
                 polygon, properties = Polygons.read_geojson(area)
             except Exception as e:
                 print(f"Failed to read '{area}'!\n{str(e)}")
+                incomplete.add(data_name)
                 continue
             #print(f"DEBUG:\n{polygon}")
 
             # Set config key (search area)
-            #print(f"DEBUG: config.search -->\n{config.search}")
             search = config.search.copy()
             search.update(properties)
-            #config.search["footprint"] = f"\"Intersects({polygon})\""
-            #print(f"DEBUG: config.search -->\n{config.search}")
-            #print(f"Config 'search' section:\n{config.search}")
-
-            snapshots = data_hub.search(search, area=polygon)
-            snapshots = sorted(snapshots,
-                               key=lambda item: item.begin_position)
-
-            print(f"\n=== {len(snapshots)} snapshots found ===\n")
-            # print_snapshots(snapshots) # DEBUG
-            # break # DEBUG
-
-            print(f"\n=== Processing snapshots and shapes ===\n")
-            for index, snapshot in enumerate(snapshots):
-                filename = sync_with_aws(s3, s3_sync, data_hub, snapshot,
-                                         path_data)
-                if not filename:
-                    print(f"'\n{snapshot.uuid}' not synced. Skipping...")
+            queries.append((data_name, area, search, polygon))
+    options_batch = config.processing.get('batch_search', None) or {}
+    if options_batch.get('enable', False):
+        # One hub query per group of areas with the same parameters
+        batch = BatchSearch(searches or data_hub,
+                            options_batch.get('max_ratio', 4.0),
+                            config.verbose)
+        results = batch.search([(search, polygon)
+                                for _, _, search, polygon in queries])
+        incomplete.update(queries[i][0] for i in batch.incomplete)
+    else:
+        results = []
+        for data_name, area, search, polygon in queries:
+            print(f"\n=== Searching '{area}' ===\n")
+            searcher = searches or data_hub
+            results.append(searcher.search(search, area=polygon))
+            if not searcher.complete:
+                incomplete.add(data_name)
+    if incomplete:
+        print(f"\n=== Searches incomplete for",
+              f"{', '.join(sorted(incomplete))} ===\n")
+
+    # Snapshot-major order: each product is fetched and decoded once for all
+    # the (set, area, shapes) targets it was found for
+    jobs: Dict[str, List[Tuple[str, str, List[str], str]]] = {}
+    found: List[Any] = []
+    # Footprints barely covering an area or its shapes are not downloaded
+    coverage = Coverage.from_options(config.processing.get('coverage', None))
+    for (data_name, area, search, polygon), snapshots in zip(queries,
+                                                              results):
+        print(f"\n=== {len(snapshots)} snapshots found for '{area}' ===\n")
+        # print_snapshots(snapshots) # DEBUG
+        filtered = 0
+        for snapshot in snapshots:
+            shapes = sets[data_name][1]
+            if coverage:
+                shapes, skipped = coverage.select(snapshot, polygon, shapes)
+                if journal:
+                    for shape in skipped:
+                        if not journal.done(data_name, area, snapshot.uuid,
+                                            shape):
+                            journal.mark(data_name, area, snapshot.uuid,
+                                         shape, 'skipped')
+                if not shapes:
+                    filtered += 1
                     continue
+            if snapshot.uuid not in jobs:
+                jobs[snapshot.uuid] = []
+                found.append(snapshot)
+            target = (data_name, area, shapes, search['platformName'])
+            if target not in jobs[snapshot.uuid]:
+                jobs[snapshot.uuid].append(target)
+        if filtered:
+            print(f"=== {filtered} snapshots skipped by coverage ===")
+    # Columnar copy: sorted on arrays, snapshots are made again one by one
+    # as the pipeline takes them
+    snapshots = SnapshotTable.from_snapshots(found).sort()
+    del found
+
+    print(f"\n=== Processing {len(snapshots)} snapshots for",
+          f"{len(queries)} areas ===\n")
+    manifest: Dict[str, Tuple[int, int]] = {} # uploaded output objects
+    failed: Set[str] = set() # sets with failed snapshots
+
+    def fetch(item: Tuple[int, Any]) -> Tuple[Any, str, List[Tuple]]:
+        index, snapshot = item
+        try:
+            targets = []
+            for data_name, area, shapes, platform in jobs[snapshot.uuid]:
+                if journal:
+                    todo = journal.pending(data_name, area, snapshot.uuid,
+                                           shapes)
                 else:
-                    print(f"\n{index:8d}: {snapshot.title}")
-                try:
-                    # Process each superposition of an area and a shape
-                    #
-                    # Process a snapshot
-                    #
-                    #print(f"DEBUG: search keys = {search.keys()}")
-                    path_target = os.path.join(path_output, data_name)
-                    #print(f"DEBUG: path_data = '{path_data}'")
-                    if search['platformName'] == 'Sentinel-2':
-                        filenames = process_sentinel2(filename, path_target,
-                                                      area, shapes)
-                    elif search['platformName'] == 'Sentinel-1':
-                        filenames = process_sentinel1(filename, path_target,
-                                                      area, shapes)
-                    else:
-                        filenames = []
-                        print(f"NOT IMPLEMENTED: {snapshot.title}",
-                              f"{config.search['platformName']}")
-                    #print(f"DEBUG: exporting '{data_prefix}' to S3 -->")
-                    # Put processing result (for each output set) to S3
-                    result = put_to_aws(s3, s3_output, path_output) # result...
-                    for outfile in filenames:
-                        remove(outfile) # all files (TODO: file or directory)
-                except Exception as e:
-                    print(f"FAILED: {e}")
-                    raise e
+                    todo = shapes
+                if todo:
+                    targets.append((data_name, area, todo, platform))
+            if not targets:
+                return None # done in an earlier cycle
+            filename = sync_with_aws(s3, s3_sync, data_hub, snapshot,
+                                     path_data, transfer, cache)
+        except Exception:
+            failed.update(data_name for data_name, *_ in jobs[snapshot.uuid])
+            raise
+        if not filename:
+            print(f"'\n{snapshot.uuid}' not synced. Skipping...")
+            failed.update(data_name for data_name, *_ in targets)
+            return None
+        print(f"\n{index:8d}: {snapshot.title}",
+              f"({len(targets)} areas)")
+        return snapshot, filename, targets
+
+    def process(item: Tuple[Any, str, List[Tuple]]
+            ) -> Tuple[Any, List[str], List[Tuple]]:
+        snapshot, filename, targets = item
+        arguments = (targets[0][3], filename,
+                     [(os.path.join(path_output, data_name), area, todo)
+                      for data_name, area, todo, _ in targets],
+                     config.processing)
+        try:
+            if pool:
+                filenames = pool.run(process_snapshot, *arguments)
+            else:
+                filenames = process_snapshot(*arguments)
+        except Exception:
+            for data_name, area, todo, _ in targets:
+                failed.add(data_name)
+                if journal:
+                    for shape in todo:
+                        journal.mark(data_name, area, snapshot.uuid, shape,
+                                     'failed')
+            raise
+        finally:
+            if cache:
+                cache.unpin(snapshot.uuid) # keep snapshot cached
+            else:
                 remove(filename) # remove snapshot
-                #break # DEBUG: the first snapshot only
-            print(f"\n=== Done snapshots for '{area}' ===\n")
+        return snapshot, filenames, targets
+
+    def publish(item: Tuple[Any, List[str], List[Tuple]]) -> List[str]:
+        snapshot, filenames, targets = item
+        # Put processing result (for each output set) to S3
+        try:
+            objects = put_to_aws(s3, s3_output, path_output, filenames,
+                                 manifest, transfer)
+        except Exception:
+            failed.update(data_name for data_name, *_ in targets)
+            raise
+        for outfile in filenames:
+            remove(outfile) # all files (TODO: file or directory)
+        if journal:
+            # Marked after upload: a crash before redoes the unit
+            for data_name, area, todo, _ in targets:
+                prefix = f"{s3_output.strip('/')}/{data_name}/".lstrip('/')
+                products = [s3o for s3o in objects if s3o.startswith(prefix)]
+                for shape in todo:
+                    journal.mark(data_name, area, snapshot.uuid, shape,
+                                 'done', products)
+            journal.sync({data_name for data_name, *_ in targets})
+        return objects
+
+    pipeline = Pipeline([
+        (fetch, options_pipeline.get('fetch', 1)),
+        (process, pool.processes if pool
+                  else options_pipeline.get('process', 1)),
+        (publish, options_pipeline.get('publish', 1))
+    ], options_pipeline.get('queue', 1))
+    pipeline.run(enumerate(snapshots))
+    if pipeline.errors:
+        # Report and go on (keep the daemon up)
+        print(f"\n=== {len(pipeline.errors)} snapshots failed",
+              f"({', '.join(sorted(failed))}) ===\n")
+    print(f"\n=== Done snapshots ===\n")
+    # A set is finished only when all its areas were searched in full, no
+    # unit is left and some unit was output: failed units are retried next
+    # cycle, sets without output are searched again (as before the journal)
+    unfinished = failed | incomplete
+    if journal:
+        for uuid, targets in jobs.items():
+            for data_name, area, shapes, _ in targets:
+                if (data_name not in unfinished
+                        and journal.pending(data_name, area, uuid, shapes)):
+                    unfinished.add(data_name)
+    for data_name in sets:
+        if (journal and data_name not in unfinished
+                and journal.produced(data_name)):
+            journal.finish(data_name)
         # Clean up output set (there should remain only logs)
         try:
             rmtree(os.path.join(path_output, data_name)) # data output - prefix
         except FileNotFoundError as e:
             pass
+    if journal:
+        journal.sync() # failed and skipped units
     # Clean up
-    for path in (path_data, path_input, path_output):
+    if pool:
+        pool.close()
+    clean_data(path_data)
+    for path in (path_input, path_output):
         try:
             #print(f"DEBUG: removing {path}")
             rmtree(path)
         except FileNotFoundError as e:
             pass
 
+    if cache:
+        print(f"Product cache: {cache.stats}")
     #print(f"\n=== Completed input processing cycle ===\n")
     periodic.enter(INTERVAL, 1, main, (periodic,))
 
@@ -0,0 +1,247 @@
+import os
+import queue
+import itertools
+import threading
+import traceback
+import multiprocessing as mp
+
+from concurrent.futures import Future
+from multiprocessing.connection import Connection, wait
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+
+from utils import get_rss
+
+
+# Stage: (function, number of worker threads)
+Stage = Tuple[Callable[[Any], Any], int]
+
+
+class Pipeline:
+    # Items flow through the stages connected by bounded queues: a full queue
+    # blocks the upstream stage (backpressure), so at most
+    # workers + queue_size items are held between any two stages. A stage
+    # function returning None drops the item
+    _done = object()
+
+    def __init__(self, stages: Sequence[Stage], queue_size: int = 1) -> None:
+        self.stages = [(function, max(1, workers))
+                       for function, workers in stages]
+        self.queue_size = max(1, queue_size)
+        self.errors: List[Exception] = []
+        self._lock = threading.Lock()
+
+    def run(self, items: Iterable[Any]) -> List[Any]:
+        self.errors = []
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        queues.append(queue.Queue()) # results (unbounded)
+        threads = []
+        for i, (function, workers) in enumerate(self.stages):
+            if i + 1 < len(self.stages):
+                downstream = self.stages[i + 1][1]
+            else:
+                downstream = 1
+            remaining = [workers]
+            for _ in range(workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(function, queues[i], queues[i + 1],
+                          remaining, downstream),
+                    daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+        for item in items:
+            queues[0].put(item)
+        for _ in range(self.stages[0][1]):
+            queues[0].put(self._done)
+        for thread in threads:
+            thread.join()
+
+        results = []
+        while True:
+            result = queues[-1].get()
+            if result is self._done:
+                break
+            results.append(result)
+
+        return results
+
+    def _work(self, function: Callable[[Any], Any],
+            source: queue.Queue, target: queue.Queue,
+            remaining: List[int], downstream: int
+        ) -> None:
+        while True:
+            item = source.get()
+            if item is self._done:
+                break
+            try:
+                result = function(item)
+            except Exception as e:
+                print(f"FAILED: {type(e).__name__}: {e}")
+                with self._lock:
+                    self.errors.append(e)
+                continue
+            if result is not None:
+                target.put(result)
+        # The last worker of a stage signals the next stage to finish
+        with self._lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(downstream):
+                target.put(self._done)
+
+        return None
+
+
+class ProcessError(Exception):
+    pass
+
+
+def _serve(tasks: mp.Queue, results: Connection,
+        max_jobs: int = None, max_rss: int = None
+    ) -> None:
+    # Worker loop: exit (to be replaced) after max_jobs jobs or once the
+    # resident memory exceeds max_rss bytes. Results go through a pipe
+    # synchronously, so nothing is lost if the worker crashes afterwards
+    jobs = 0
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job, function, args, kwargs = task
+        results.send(('start', job, None))
+        try:
+            results.send(('done', job, function(*args, **kwargs)))
+        except Exception as e:
+            results.send(('error', job,
+                          f"{type(e).__name__}: {e}\n"
+                          f"{traceback.format_exc()}"))
+        jobs += 1
+        if max_jobs and jobs >= max_jobs:
+            break
+        if max_rss and get_rss() > max_rss:
+            break
+    results.close()
+
+    return None
+
+
+class ProcessPool:
+    # Pool of spawned worker processes with recycling: GDAL block caches and
+    # heap fragmentation go away with the worker. A failed job (exception or
+    # a crashed worker) resolves its future with ProcessError
+    def __init__(self, processes: int = None,
+            max_jobs: int = None, max_rss: int = None) -> None:
+        self.processes = processes or os.cpu_count() or 1
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self._context = mp.get_context('spawn')
+        self._tasks = self._context.Queue()
+        self._workers: Dict[int, Tuple[mp.Process, Connection]] = {}
+        self._running: Dict[int, int] = {} # pid -> job
+        self._futures: Dict[int, Future] = {}
+        self._jobs = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+        for _ in range(self.processes):
+            self._spawn()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def submit(self, function: Callable[..., Any],
+            *args, **kwargs) -> Future:
+        assert not self._closed, "pool is closed!"
+        future = Future()
+        with self._lock:
+            job = next(self._jobs)
+            self._futures[job] = future
+        self._tasks.put((job, function, args, kwargs))
+
+        return future
+
+    def run(self, function: Callable[..., Any], *args, **kwargs) -> Any:
+        return self.submit(function, *args, **kwargs).result()
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            workers = len(self._workers)
+        for _ in range(workers):
+            self._tasks.put(None)
+        self._collector.join()
+
+        return None
+
+    def _spawn(self) -> None:
+        reader, writer = self._context.Pipe(duplex=False)
+        worker = self._context.Process(
+            target=_serve,
+            args=(self._tasks, writer, self.max_jobs, self.max_rss),
+            daemon=True
+        )
+        worker.start()
+        writer.close()
+        self._workers[worker.pid] = (worker, reader)
+
+        return None
+
+    def _collect(self) -> None:
+        while True:
+            with self._lock:
+                if self._closed and not self._workers:
+                    break
+                waitables = {}
+                for pid, (worker, reader) in self._workers.items():
+                    waitables[reader] = pid
+                    waitables[worker.sentinel] = pid
+            for ready in wait(list(waitables), timeout=1):
+                with self._lock:
+                    self._handle(waitables[ready])
+
+        return None
+
+    def _handle(self, pid: int) -> None:
+        if pid not in self._workers:
+            return None
+        worker, reader = self._workers[pid]
+        try:
+            while reader.poll():
+                state, job, value = reader.recv()
+                if state == 'start':
+                    self._running[pid] = job
+                elif state == 'done':
+                    self._resolve(pid, job, result=value)
+                elif state == 'error':
+                    self._resolve(pid, job, error=ProcessError(value))
+        except EOFError:
+            pass
+        if worker.is_alive():
+            return None
+        # Worker is gone: recycled, closed or crashed (e.g. a segfault in
+        # GDAL), in the latter case its running job fails
+        worker.join()
+        reader.close()
+        del self._workers[pid]
+        job = self._running.pop(pid, None)
+        if job is not None:
+            self._resolve(pid, job, error=ProcessError(
+                f"worker {pid} died (exit code {worker.exitcode})"
+            ))
+        if not self._closed:
+            self._spawn()
+
+        return None
+
+    def _resolve(self, pid: int, job: int, result: Any = None,
+            error: Exception = None) -> None:
+        self._running.pop(pid, None)
+        future = self._futures.pop(job, None)
+        if future is None:
+            return None
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+        return None
@@ -0,0 +1,435 @@
+import os
+import zipfile
+import numpy as np
+
+from glob import glob
+from osgeo import gdal, ogr, osr
+from typing import Iterator, List, Tuple
+
+
+# Default window size for block streaming (pixels per window)
+BLOCK_PIXELS: int = 4194304
+
+# SAFE members needed to open measurements (manifest, product annotations
+# with geolocation grid, measurement images)
+SAFE_MEMBERS: Tuple[str, ...] = ('manifest.safe', 'annotation/', 'measurement/')
+
+# Pixels added around a planned source window (resampling kernels, GCP
+# transform error)
+WINDOW_MARGIN: int = 16
+
+# Points per envelope edge transformed to pixel space
+WINDOW_DENSITY: int = 16
+
+Window = Tuple[int, int, int, int]
+
+
+class RunningStats:
+    # Streaming mean/std accumulator (Chan et al. parallel merge): each
+    # update() folds a chunk in, so no full-scene array is ever needed
+    def __init__(self) -> None:
+        self.count = 0
+        self.mean_ = 0.0
+        self.m2 = 0.0
+
+    def update(self, values: np.ndarray) -> None:
+        count = values.size
+        if not count:
+            return None
+        values = values.astype(np.float64, copy=False)
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        delta = mean - self.mean_
+        total = self.count + count
+        self.mean_ += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+        return None
+
+    @property
+    def mean(self) -> np.float32:
+        return np.float32(self.mean_)
+
+    @property
+    def std(self) -> np.float32:
+        if not self.count:
+            return np.float32(0)
+        return np.float32(np.sqrt(self.m2 / self.count))
+
+
+def iter_windows(band: gdal.Band,
+        max_pixels: int = BLOCK_PIXELS
+    ) -> Iterator[Window]:
+    # Walk the native block grid: merge whole blocks into windows of at most
+    # max_pixels (but never less than a single block)
+    block_x, block_y = band.GetBlockSize()
+    size_x, size_y = band.XSize, band.YSize
+    if block_x >= size_x:
+        # Strip layout: merge block rows
+        step_x = size_x
+        step_y = max(1, max_pixels // (size_x * block_y)) * block_y
+    else:
+        # Tiled layout: merge tiles along a row first
+        step_x = max(1, max_pixels // (block_x * block_y)) * block_x
+        step_x = min(step_x, size_x)
+        step_y = max(1, max_pixels // (step_x * block_y)) * block_y
+    for yoff in range(0, size_y, step_y):
+        ysize = min(step_y, size_y - yoff)
+        for xoff in range(0, size_x, step_x):
+            xsize = min(step_x, size_x - xoff)
+            yield xoff, yoff, xsize, ysize
+
+
+def locate_safe(filename: str, path_temp: str,
+        mode: str = 'extract'
+    ) -> str:
+    # Return a path GDAL can open the SAFE product with: 'vsizip' reads it in
+    # place, 'select' extracts only SAFE_MEMBERS, 'extract' unpacks all
+    with zipfile.ZipFile(filename, 'r') as archive:
+        names = archive.namelist()
+        manifests = [name for name in names
+                     if name.endswith('.SAFE/manifest.safe')]
+        if not manifests:
+            raise FileNotFoundError(f"no SAFE manifest in {filename}")
+        path_safe = os.path.dirname(manifests[0])
+        if mode == 'vsizip':
+            path_zip = os.path.abspath(filename)
+            return f"/vsizip/{path_zip}/{manifests[0]}"
+        elif mode == 'select':
+            prefixes = tuple(f"{path_safe}/{member}"
+                             for member in SAFE_MEMBERS)
+            for name in names:
+                if not name.startswith(prefixes):
+                    continue
+                # Skip calibration/noise/RFI annotations (never read)
+                if name.count('/') > 2 and name.startswith(prefixes[1]):
+                    continue
+                archive.extract(name, path_temp)
+        elif mode == 'extract':
+            archive.extractall(path_temp)
+        else:
+            raise ValueError(f"unknown SAFE access mode '{mode}'")
+
+    return glob(os.path.join(path_temp, f"*.SAFE"))[0]
+
+
+def get_histogram(image: np.ndarray) -> np.ndarray:
+    # Value counts of an unsigned integer image (one pass, no float copy)
+    levels = np.iinfo(image.dtype).max + 1
+
+    return np.bincount(image.ravel(), minlength=levels)
+
+
+def get_tanh_lut(levels: int, mean: float, gamma: float = None,
+        scale: float = 2.0
+    ) -> np.ndarray:
+    # Byte lookup table of the tanh stretch v -> tanh(v / clip) ^ (1 / gamma)
+    # * 254 + 1, clip being scale times the mean
+    clip = np.float32(mean * scale) or np.float32(1)
+    table = np.tanh(np.arange(levels, dtype=np.float32) / clip)
+    if gamma and gamma != 1:
+        np.power(table, np.float32(1 / gamma), out=table)
+    table *= 254
+    table += 1
+
+    return table.round().astype(np.uint8)
+
+
+def get_stretch_lut(histogram: np.ndarray, gamma: float = None,
+        scale: float = 2.0
+    ) -> np.ndarray:
+    # Tanh stretch table with the mean taken from the histogram
+    levels = np.arange(histogram.size, dtype=np.float64)
+    mean = (histogram * levels).sum() / max(histogram.sum(), 1)
+
+    return get_tanh_lut(histogram.size, mean, gamma, scale)
+
+
+def stretch_bands(images: List[np.ndarray], mode: str = 'global',
+        gamma: float = None, scale: float = 2.0, means: List[float] = None
+    ) -> List[np.ndarray]:
+    # LUT stretch of integer bands: one gather per pixel. 'global' takes the
+    # clip from all the bands (as the float stretch did), 'band' per band.
+    # Band means given (approximate statistics) replace the histograms
+    if mode not in ('band', 'global'):
+        raise ValueError(f"unknown stretch mode '{mode}'")
+    if means is not None:
+        levels = [np.iinfo(image.dtype).max + 1 for image in images]
+        if mode == 'global':
+            pixels = sum(image.size for image in images)
+            total = sum(mean * image.size
+                        for mean, image in zip(means, images))
+            means = [total / pixels] * len(images)
+        tables = [get_tanh_lut(n, mean, gamma, scale)
+                  for n, mean in zip(levels, means)]
+    elif mode == 'band':
+        tables = [get_stretch_lut(get_histogram(image), gamma, scale)
+                  for image in images]
+    else:
+        histogram = sum(get_histogram(image) for image in images)
+        tables = [get_stretch_lut(histogram, gamma, scale)] * len(images)
+
+    return [np.take(table, image) for table, image in zip(tables, images)]
+
+
+def copy_georeference(source: gdal.Dataset, target: gdal.Dataset) -> None:
+    if source.GetGCPCount():
+        target.SetGCPs(source.GetGCPs(), source.GetGCPProjection())
+    else:
+        target.SetGeoTransform(source.GetGeoTransform())
+        target.SetProjection(source.GetProjection())
+    metadata = source.GetMetadata()
+    if metadata:
+        target.SetMetadata(metadata)
+
+    return None
+
+
+def get_clip(image: np.ndarray, valid: np.ndarray) -> np.float32:
+    # Mean + 2 std of the valid pixels, from sums (no float copy)
+    count = max(int(np.count_nonzero(valid)), 1)
+    total = image.sum(dtype=np.float64) # nodata is zero
+    squares = np.einsum('ij,ij->', image, image, dtype=np.float64)
+    mean = total / count
+    std = np.sqrt(max(squares / count - mean ** 2, 0.0))
+
+    return np.float32(mean + 2 * std)
+
+
+def to_byte(buffer: np.ndarray, mask: np.ndarray,
+        nodata: int = 0) -> np.ndarray:
+    # Stretched [0, 1] buffer -> 1..255 bytes in place, nodata off the mask
+    np.multiply(buffer, np.float32(254), out=buffer)
+    np.add(buffer, np.float32(1), out=buffer)
+    image = np.full(buffer.shape, nodata, dtype=np.uint8)
+    np.copyto(image, buffer, casting='unsafe', where=mask)
+
+    return image
+
+
+def compose_sentinel1_arrays(image_hh: np.ndarray, image_hv: np.ndarray,
+        clips: Tuple[np.float32, np.float32] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Fused (HH, HV, HH/HV, 1 - HH/HV) byte composite with plain float32
+    # buffers, an explicit nodata mask and in-place ufuncs: the ratio is
+    # computed once for both ratio and negative bands. Nodata as the masked
+    # array code wrote it: 0 (1 in the negative band where HH is nodata).
+    # Clips (HH, HV) not given are taken from the images
+    valid_hh = image_hh != 0
+    valid_hv = image_hv != 0
+    valid = valid_hh & valid_hv
+    if clips is None:
+        clips = (get_clip(image_hh, valid_hh), get_clip(image_hv, valid_hv))
+    buffer_hh = np.empty(image_hh.shape, dtype=np.float32)
+    buffer_hv = np.empty(image_hv.shape, dtype=np.float32)
+    np.divide(image_hh, clips[0], out=buffer_hh)
+    np.tanh(buffer_hh, out=buffer_hh)
+    np.divide(image_hv, clips[1], out=buffer_hv)
+    np.tanh(buffer_hv, out=buffer_hv)
+    ratio = np.zeros(image_hh.shape, dtype=np.float32)
+    np.divide(buffer_hh, buffer_hv, out=ratio, where=valid)
+    byte_hh = to_byte(buffer_hh, valid_hh)
+    byte_hv = to_byte(buffer_hv, valid_hv)
+    # HH/HV buffers are free: negative goes to one of them
+    np.tanh(ratio, out=buffer_hh)
+    np.subtract(np.float32(1), buffer_hh, out=buffer_hh)
+    byte_negative = to_byte(buffer_hh, valid, 1)
+    byte_negative[valid_hh & ~valid_hv] = 0
+    del buffer_hh, buffer_hv
+    ratio_max = ratio.max() or np.float32(1)
+    np.divide(ratio, ratio_max, out=ratio)
+    byte_ratio = to_byte(ratio, valid)
+
+    return byte_hh, byte_hv, byte_ratio, byte_negative
+
+
+def compose_sentinel1_blocks(source: gdal.Dataset, destination: str,
+        max_pixels: int = BLOCK_PIXELS,
+        clips: Tuple[np.float32, np.float32] = None
+    ) -> gdal.Dataset:
+    # Build the 4-band (HH, HV, HH/HV, 1 - HH/HV) byte composite window by
+    # window into a tiled GTiff, so memory depends on the window size only
+    band_hh = source.GetRasterBand(1)
+    band_hv = source.GetRasterBand(2)
+    windows = list(iter_windows(band_hh, max_pixels))
+
+    # Pass 1: polarization statistics (zero is nodata), unless clips given
+    if clips is None:
+        stats_hh, stats_hv = RunningStats(), RunningStats()
+        for window in windows:
+            image_hh = band_hh.ReadAsArray(*window)
+            stats_hh.update(image_hh[image_hh != 0])
+            del image_hh
+            image_hv = band_hv.ReadAsArray(*window)
+            stats_hv.update(image_hv[image_hv != 0])
+            del image_hv
+        clips = (stats_hh.mean + np.float32(2) * stats_hh.std,
+                 stats_hv.mean + np.float32(2) * stats_hv.std)
+    clip_hh, clip_hv = clips
+
+    def stretch(window: Window) -> Tuple[np.ndarray, ...]:
+        image_hh = band_hh.ReadAsArray(*window)
+        image_hv = band_hv.ReadAsArray(*window)
+        valid_hh = image_hh != 0
+        valid_hv = image_hv != 0
+        image_hh = np.tanh(image_hh / clip_hh, dtype=np.float32)
+        image_hv = np.tanh(image_hv / clip_hv, dtype=np.float32)
+        image_ratio = np.zeros_like(image_hh)
+        np.divide(image_hh, image_hv, out=image_ratio,
+                  where=valid_hh & valid_hv)
+        return image_hh, image_hv, image_ratio, valid_hh, valid_hv
+
+    # Pass 2: ratio maximum (it depends on the stretched polarizations)
+    ratio_max = np.float32(0)
+    for window in windows:
+        image_ratio = stretch(window)[2]
+        ratio_max = max(ratio_max, image_ratio.max())
+        del image_ratio
+    if not ratio_max:
+        ratio_max = np.float32(1)
+
+    # Pass 3: write byte bands (nodata as in compose_sentinel1_arrays)
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(destination, source.RasterXSize,
+                            source.RasterYSize, 4, gdal.GDT_Byte,
+                            ['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    copy_georeference(source, dataset)
+    bands = [dataset.GetRasterBand(i + 1) for i in range(4)]
+    for window in windows:
+        image_hh, image_hv, image_ratio, valid_hh, valid_hv = stretch(window)
+        valid = valid_hh & valid_hv
+        image_negative = np.tanh(image_ratio)
+        np.subtract(np.float32(1), image_negative, out=image_negative)
+        np.divide(image_ratio, ratio_max, out=image_ratio)
+        byte_negative = to_byte(image_negative, valid, 1)
+        byte_negative[valid_hh & ~valid_hv] = 0
+        images = (to_byte(image_hh, valid_hh), to_byte(image_hv, valid_hv),
+                  to_byte(image_ratio, valid), byte_negative)
+        for band, image in zip(bands, images):
+            band.WriteArray(image, window[0], window[1])
+        del image_hh, image_hv, image_ratio, image_negative, images
+    del bands
+    dataset.FlushCache()
+
+    return dataset
+
+
+def select_bands(dataset: gdal.Dataset, bands: Tuple[int, ...],
+        metadata: dict = None
+    ) -> gdal.Dataset:
+    # In-memory VRT view over a subset of bands (no pixel copy)
+    view = gdal.Translate('', dataset, format='VRT', bandList=list(bands))
+    colors = (gdal.GCI_RedBand, gdal.GCI_GreenBand, gdal.GCI_BlueBand)
+    for i, color in enumerate(colors[:view.RasterCount]):
+        view.GetRasterBand(i + 1).SetColorInterpretation(color)
+    if metadata:
+        view.GetRasterBand(view.RasterCount).SetMetadata(metadata)
+
+    return view
+
+
+def warp_to_grid(source: gdal.Dataset, destination: str,
+        options_warp: dict, **kwargs
+    ) -> gdal.Dataset:
+    # Reproject to an intermediate tiled GTiff on the output grid: shapes are
+    # cut from it later by a pixel-aligned crop (no reprojection)
+    options = dict(options_warp, **kwargs)
+    options['format'] = 'GTiff'
+    options['creationOptions'] = ['TILED=YES', 'BIGTIFF=IF_SAFER']
+    options['targetAlignedPixels'] = True
+
+    return gdal.Warp(destination, source, **options)
+
+
+def get_reference(dataset: gdal.Dataset) -> osr.SpatialReference:
+    # Georeferencing SRS of a dataset (GCP SRS for Sentinel-1 measurements),
+    # in (x, y) = (lon, lat) order as the GDAL transformer expects
+    projection = dataset.GetProjection() or dataset.GetGCPProjection()
+    if not projection:
+        return None
+    reference = osr.SpatialReference()
+    reference.ImportFromWkt(projection)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    return reference
+
+
+def get_envelope(shape: str, reference: osr.SpatialReference
+    ) -> Tuple[float, float, float, float]:
+    # Envelope (min x, max x, min y, max y) of a shapefile in the SRS
+    source = ogr.Open(shape)
+    if source is None:
+        raise IOError(f"cannot open '{shape}'")
+    layer = source.GetLayer()
+    transform = None
+    if layer.GetSpatialRef() is not None:
+        layer_reference = layer.GetSpatialRef().Clone()
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            layer_reference.SetAxisMappingStrategy(
+                osr.OAMS_TRADITIONAL_GIS_ORDER
+            )
+        transform = osr.CoordinateTransformation(layer_reference, reference)
+    envelopes: List[Tuple[float, float, float, float]] = []
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        if transform:
+            geometry.Transform(transform)
+        envelopes.append(geometry.GetEnvelope())
+    del layer, source
+    if not envelopes:
+        return None
+
+    return (min(e[0] for e in envelopes), max(e[1] for e in envelopes),
+            min(e[2] for e in envelopes), max(e[3] for e in envelopes))
+
+
+def plan_window(source: gdal.Dataset, shape: str,
+        margin: int = WINDOW_MARGIN
+    ) -> Window:
+    # Source pixel window covering a shapefile: the shape envelope is taken
+    # to the source SRS, its densified edges to pixel space (geotransform or
+    # GCPs) and the bounds are clipped to the raster. None if the shape
+    # misses the scene; the whole raster if the shape can't be located
+    whole = (0, 0, source.RasterXSize, source.RasterYSize)
+    reference = get_reference(source)
+    if reference is None:
+        return whole
+    envelope = get_envelope(shape, reference)
+    if envelope is None:
+        return None
+    min_x, max_x, min_y, max_y = envelope
+    steps = np.linspace(0, 1, WINDOW_DENSITY)
+    xs = min_x + (max_x - min_x) * steps
+    ys = min_y + (max_y - min_y) * steps
+    points = ([(x, min_y, 0) for x in xs] + [(x, max_y, 0) for x in xs]
+              + [(min_x, y, 0) for y in ys] + [(max_x, y, 0) for y in ys])
+    transformer = gdal.Transformer(source, None, [])
+    pixels, success = transformer.TransformPoints(1, points) # geo -> pixel
+    pixels = [pixel for pixel, ok in zip(pixels, success) if ok]
+    if not pixels:
+        return whole
+    xoff = int(np.floor(min(pixel[0] for pixel in pixels))) - margin
+    yoff = int(np.floor(min(pixel[1] for pixel in pixels))) - margin
+    xend = int(np.ceil(max(pixel[0] for pixel in pixels))) + margin
+    yend = int(np.ceil(max(pixel[1] for pixel in pixels))) + margin
+    xoff, yoff = max(xoff, 0), max(yoff, 0)
+    xend = min(xend, source.RasterXSize)
+    yend = min(yend, source.RasterYSize)
+    if xend <= xoff or yend <= yoff:
+        return None
+
+    return xoff, yoff, xend - xoff, yend - yoff
+
+
+def crop_window(source: gdal.Dataset, window: Window) -> gdal.Dataset:
+    # In-memory VRT over a source window (GCPs or geotransform shifted), so
+    # a warp reads only the window
+    if window == (0, 0, source.RasterXSize, source.RasterYSize):
+        return source
+
+    return gdal.Translate('', source, format='VRT', srcWin=list(window))
@@ -1,4 +1,9 @@
+from .batch import BatchSearch
+from .catalog import Catalog
 from .config import Config
 from .model import Filters
 from .model import Polygons
 from .search import DataHub
+from .delta import DeltaSearch
+from .match import match_nearest
+from .table import SnapshotTable
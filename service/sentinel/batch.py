@@ -0,0 +1,92 @@
+import json
+
+from typing import Any, Dict, List, Set, Tuple
+
+from shapely import wkt
+from shapely.ops import unary_union
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from .match import query_tree
+from .model import Snapshot
+
+
+class BatchSearch:
+    # Areas searched with the same parameters (and lying close together)
+    # are searched once with the convex hull of the group; the results are
+    # assigned back to the areas by an STR-tree over the area polygons.
+    # An area is not merged when the hull would exceed max_ratio times the
+    # union of the areas (the hub would return mostly unrelated snapshots)
+    def __init__(self, searcher: Any, max_ratio: float = 4.0,
+            verbose: bool = False) -> None:
+        self.searcher = searcher # DataHub, DeltaSearch or Catalog
+        self.max_ratio = max_ratio
+        self.verbose = verbose
+        self.incomplete: Set[int] = set() # queries of cut short searches
+
+    def search(self, queries: List[Tuple[Dict[str, Any], str]]
+            ) -> List[List[Snapshot]]:
+        # (params, area WKT) for each area -> snapshots for each area
+        groups: Dict[str, List[List[int]]] = {}
+        geometries = [wkt.loads(area) for _, area in queries]
+        for i, (params, _) in enumerate(queries):
+            key = json.dumps(params, sort_keys=True, default=str)
+            clusters = groups.setdefault(key, [])
+            if geometries[i].area > 0:
+                for cluster in clusters:
+                    if self._fits(cluster, i, geometries):
+                        cluster.append(i)
+                        break
+                else:
+                    clusters.append([i])
+            else:
+                clusters.append([i]) # points are searched as they are
+
+        results: List[List[Snapshot]] = [[] for _ in queries]
+        self.incomplete = set()
+        searches = 0
+        for clusters in groups.values():
+            for cluster in clusters:
+                searches += 1
+                params = dict(queries[cluster[0]][0])
+                if len(cluster) == 1:
+                    area = queries[cluster[0]][1]
+                    results[cluster[0]] = list(self.searcher.search(params,
+                                                                    area=area))
+                else:
+                    hull = unary_union([geometries[i] for i in cluster]) \
+                               .convex_hull
+                    snapshots = self.searcher.search(params, area=hull.wkt)
+                    self._assign(snapshots, cluster, geometries, results)
+                if not getattr(self.searcher, 'complete', True):
+                    self.incomplete.update(cluster)
+        if self.verbose:
+            print(f"Batch search: {searches} searches for",
+                  f"{len(queries)} areas")
+
+        return results
+
+    def _fits(self, cluster: List[int], i: int, geometries: List[Any]
+            ) -> bool:
+        union = unary_union([geometries[j] for j in cluster + [i]])
+
+        return union.convex_hull.area <= self.max_ratio * union.area
+
+    @staticmethod
+    def _assign(snapshots: List[Snapshot], cluster: List[int],
+            geometries: List[Any], results: List[List[Snapshot]]) -> None:
+        # Exact footprint tests after the STR-tree envelope query
+        areas = [geometries[i] for i in cluster]
+        tree = STRtree(areas)
+        index = {id(area): n for n, area in enumerate(areas)}
+        prepared = [prep(area) for area in areas]
+        for snapshot in snapshots:
+            if snapshot.polygon is None:
+                found = range(len(areas)) # unknown footprint: keep it
+            else:
+                found = [n for n in query_tree(tree, index, snapshot.polygon)
+                         if prepared[n].intersects(snapshot.polygon)]
+            for n in found:
+                results[cluster[n]].append(snapshot)
+
+        return None
@@ -0,0 +1,243 @@
+import re
+import json
+import sqlite3
+import threading
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Tuple
+
+from shapely import wkt
+
+from .model import Snapshot
+
+
+# Query parameters handled as ranges or geometry (not stored as attributes)
+SPECIAL_PARAMS = {
+    'beginposition', 'endposition', 'ingestiondate', 'cloudcoverpercentage',
+    'footprint', 'filename', 'filenames', 'start', 'rows', 'orderby'
+}
+
+PLATFORMS = {'S1': 'Sentinel-1', 'S2': 'Sentinel-2', 'S3': 'Sentinel-3'}
+
+
+def parse_time(value: str, now: datetime) -> float:
+    # ISO date or Solr-like 'NOW', 'NOW-3DAYS', 'NOW-12HOURS', '*' (open)
+    value = value.strip().upper()
+    if value == '*':
+        return None
+    match = re.match(r'^NOW(?:([+-])(\d+)(DAY|HOUR|MINUTE)S?)?$', value)
+    if match:
+        sign, amount, unit = match.groups()
+        moment = now
+        if sign:
+            delta = timedelta(**{f"{unit.lower()}s": int(amount)})
+            moment = now + delta if sign == '+' else now - delta
+        return moment.timestamp()
+    value = value.rstrip('Z')
+    for layout in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            moment = datetime.strptime(value, layout)
+            return moment.replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            continue
+    raise ValueError(f"bad date '{value}'")
+
+
+def parse_range(value: Any, parse: Any = float) -> Tuple[Any, Any]:
+    # '[low TO high]' -> (low, high), None for open ends
+    value = str(value).strip()
+    match = re.match(r'^\[(.+)\s+TO\s+(.+)\]$', value, re.IGNORECASE)
+    if not match:
+        point = parse(value)
+        return point, point
+
+    return parse(match.group(1)), parse(match.group(2))
+
+
+class Catalog:
+    # Local snapshot catalog (SQLite): an R-tree over footprint bounds,
+    # indices on time fields and platform, and the query attributes the
+    # snapshots were found with. Filled from hub search results, queried with
+    # the DataHub search() interface without network round trips
+    def __init__(self, path: str, verbose: bool = False) -> None:
+        self.path = path
+        self.verbose = verbose
+        self.snapshots: List[Snapshot] = None
+        self.complete = True # local answers are never cut short
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    id INTEGER PRIMARY KEY,
+                    uuid TEXT UNIQUE NOT NULL,
+                    title TEXT,
+                    platform TEXT,
+                    begin_position REAL,
+                    end_position REAL,
+                    ingestion_date REAL,
+                    cloud_coverage REAL,
+                    record TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS snapshots_begin
+                    ON snapshots (begin_position);
+                CREATE INDEX IF NOT EXISTS snapshots_ingestion
+                    ON snapshots (ingestion_date);
+                CREATE INDEX IF NOT EXISTS snapshots_platform
+                    ON snapshots (platform, begin_position);
+                CREATE TABLE IF NOT EXISTS attributes (
+                    id INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (id, name)
+                );
+                CREATE INDEX IF NOT EXISTS attributes_value
+                    ON attributes (name, value);
+                CREATE VIRTUAL TABLE IF NOT EXISTS footprints
+                    USING rtree(id, min_x, max_x, min_y, max_y);
+            """)
+
+    def add(self, snapshots: List[Snapshot],
+            params: Dict[str, Any] = None) -> int:
+        # Store (or refresh) snapshots with the query attributes they match
+        attributes = {}
+        for k, v in (params or {}).items():
+            key = k.lower()
+            if key not in SPECIAL_PARAMS and v is not None:
+                attributes[key] = str(v).strip('"').lower()
+        platform = attributes.get('platformname')
+        schema = Snapshot.Schema()
+        with self._lock, self._db:
+            for snapshot in snapshots:
+                fields = (
+                    snapshot.title,
+                    platform or PLATFORMS.get(snapshot.title[:2], '')
+                                          .lower(),
+                    self._epoch(snapshot.begin_position),
+                    self._epoch(snapshot.end_position),
+                    self._epoch(snapshot.ingestion_date),
+                    snapshot.cloud_coverage,
+                    json.dumps(schema.dump(snapshot))
+                )
+                row = self._db.execute("SELECT id FROM snapshots "
+                                       "WHERE uuid = ?",
+                                       (snapshot.uuid,)).fetchone()
+                if row:
+                    id_ = row[0]
+                    self._db.execute(
+                        "UPDATE snapshots SET title = ?, platform = ?, "
+                        "begin_position = ?, end_position = ?, "
+                        "ingestion_date = ?, cloud_coverage = ?, record = ? "
+                        "WHERE id = ?", fields + (id_,)
+                    )
+                    self._db.execute("DELETE FROM footprints WHERE id = ?",
+                                     (id_,))
+                else:
+                    id_ = self._db.execute(
+                        "INSERT INTO snapshots (title, platform, "
+                        "begin_position, end_position, ingestion_date, "
+                        "cloud_coverage, record, uuid) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        fields + (snapshot.uuid,)
+                    ).lastrowid
+                if snapshot.polygon is not None:
+                    min_x, min_y, max_x, max_y = snapshot.polygon.bounds
+                    self._db.execute("INSERT INTO footprints "
+                                     "VALUES (?, ?, ?, ?, ?)",
+                                     (id_, min_x, max_x, min_y, max_y))
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO attributes VALUES (?, ?, ?)",
+                    [(id_, k, v) for k, v in attributes.items()]
+                )
+
+        return len(snapshots)
+
+    def search(self, params: Dict[str, Any], area=None) -> List[Snapshot]:
+        now = datetime.now(timezone.utc)
+        clauses: List[str] = []
+        values: List[Any] = []
+        geometry = None
+        if type(area) is str and area:
+            geometry = wkt.loads(area)
+        for k, v in params.items():
+            key = k.lower()
+            if key in ('beginposition', 'endposition', 'ingestiondate'):
+                column = {'beginposition': 'begin_position',
+                          'endposition': 'end_position',
+                          'ingestiondate': 'ingestion_date'}[key]
+                low, high = parse_range(v, lambda t: parse_time(t, now))
+                self._between(clauses, values, column, low, high)
+            elif key == 'cloudcoverpercentage':
+                low, high = parse_range(
+                    v, lambda c: None if c.strip() == '*' else float(c)
+                )
+                self._between(clauses, values, 'cloud_coverage', low, high)
+            elif key == 'footprint':
+                if geometry is None:
+                    match = re.search(r'Intersects\((.+)\)', str(v),
+                                      re.IGNORECASE)
+                    try:
+                        geometry = wkt.loads(match.group(1))
+                    except Exception:
+                        print(f"WARNING: unsupported footprint {v}")
+            elif key == 'platformname' and v is not None:
+                # Indexed column (with begin_position), not an attribute
+                clauses.append("platform = ?")
+                values.append(str(v).strip('"').lower())
+            elif key == 'filenames':
+                if type(v) is list and v:
+                    clauses.append(f"title IN ({', '.join('?' * len(v))})")
+                    values.extend(name.split('.')[0] for name in v)
+            elif key not in SPECIAL_PARAMS and v is not None:
+                clauses.append("id IN (SELECT id FROM attributes "
+                               "WHERE name = ? AND value = ?)")
+                values.extend((key, str(v).strip('"').lower()))
+        if geometry is not None:
+            min_x, min_y, max_x, max_y = geometry.bounds
+            clauses.append("id IN (SELECT id FROM footprints "
+                           "WHERE min_x <= ? AND max_x >= ? "
+                           "AND min_y <= ? AND max_y >= ?)")
+            values.extend((max_x, min_x, max_y, min_y))
+
+        query = "SELECT record FROM snapshots"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY begin_position"
+        with self._lock:
+            rows = self._db.execute(query, values).fetchall()
+        schema = Snapshot.Schema()
+        snapshots = [schema.load(json.loads(row[0])) for row in rows]
+        if geometry is not None:
+            # Exact test after the R-tree bounding box filter
+            snapshots = [snapshot for snapshot in snapshots
+                         if snapshot.polygon is None
+                         or snapshot.polygon.intersects(geometry)]
+        if self.verbose:
+            print(f"Catalog: {len(snapshots)} records found")
+        self.snapshots = snapshots
+
+        return self.snapshots
+
+    def close(self) -> None:
+        self._db.close()
+
+        return None
+
+    @staticmethod
+    def _epoch(value: datetime) -> float:
+        return value.timestamp() if value else None
+
+    @staticmethod
+    def _between(clauses: List[str], values: List[Any], column: str,
+            low: Any, high: Any) -> None:
+        if low is not None:
+            clauses.append(f"{column} >= ?")
+            values.append(low)
+        if high is not None:
+            clauses.append(f"{column} <= ?")
+            values.append(high)
+
+        return None
+
+    def __len__(self) -> int:
+        return len(self.snapshots) if isinstance(self.snapshots, List) else 0
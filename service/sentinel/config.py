@@ -13,6 +13,10 @@ class Config:
     accounts: List[Dict[str, str]] = None
     search: Dict[str, Any] = None
     output: str = None
+    processing: Dict[str, Any] = None
+    transfer: Dict[str, Any] = None
+    connections: int = 4
+    cache: Dict[str, Any] = None
     verbose: bool = False
 
     @classmethod
@@ -29,6 +33,10 @@ class Config:
             'accounts': None,
             'search': None,
             'output': None,
+            'processing': {},
+            'transfer': {},
+            'connections': 4,
+            'cache': {},
             'verbose': False
         }
         if 'credentials' in config:
@@ -40,11 +48,19 @@ class Config:
             fields['accounts'] = config['accounts']
         if 'search' in config:
             fields['search'] = config['search']
+        if 'processing' in config and config['processing']:
+            fields['processing'] = config['processing']
+        if 'transfer' in config and config['transfer']:
+            fields['transfer'] = config['transfer']
+        if 'cache' in config and config['cache']:
+            fields['cache'] = config['cache']
         if 'download' in config:
             if 'enable' in config['download']:
                 if config['download']['enable']:
                     if 'path' in config['download']:
                         fields['output'] = config['download']['path']
+            if 'connections' in config['download']:
+                fields['connections'] = config['download']['connections']
         fields['verbose'] = 'verbose' in config and config['verbose']
 
         return cls(**fields)
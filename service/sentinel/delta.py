@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+from .catalog import parse_range, parse_time
+from .model import Snapshot
+from .search import DataHub
+
+
+# Query ranges the cached results are checked against (relative ones such
+# as '[NOW-30DAYS TO NOW]' move between searches)
+RANGE_FIELDS = {'beginposition': 'begin_position',
+                'endposition': 'end_position'}
+
+
+class DeltaSearch:
+    # Incremental search: the result list of every (area, query) pair is kept
+    # on disk with its ingestion date high-water mark, later searches only ask
+    # for 'ingestionDate:[mark TO NOW]' and merge the delta by UUID
+    def __init__(self, data_hub: DataHub, path: str) -> None:
+        self.data_hub = data_hub
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def complete(self) -> bool:
+        return self.data_hub.complete
+
+    def search(self, params: Dict[str, Any], area=None) -> List[Snapshot]:
+        if any(k.lower() == 'ingestiondate' for k in params):
+            # The query limits ingestion date itself: no delta possible
+            return self.data_hub.search(params, area=area)
+
+        key = json.dumps({'area': area, 'params': params}, sort_keys=True,
+                         default=str)
+        filename = os.path.join(self.path, hashlib.sha1(key.encode())
+                                                   .hexdigest() + '.json')
+        mark, snapshots = self._load(filename)
+
+        # Ascending order (the first search too): partial results still
+        # leave a valid mark
+        query = {k: v for k, v in params.items() if k.lower() != 'orderby'}
+        query['orderby'] = 'ingestiondate asc'
+        if mark:
+            query['ingestionDate'] = f"[{mark} TO NOW]"
+        found = self.data_hub.search(query, area=area)
+        if self.data_hub.config.verbose:
+            print(f"Delta since {mark or 'the beginning'}:",
+                  f"{len(found)} records")
+        merged = {snapshot.uuid: snapshot for snapshot in snapshots}
+        merged.update((snapshot.uuid, snapshot) for snapshot in found)
+        snapshots = self._within(params, list(merged.values()))
+        if snapshots:
+            self._save(filename, snapshots)
+        self.data_hub.snapshots = snapshots
+
+        return snapshots
+
+    @staticmethod
+    def _within(params: Dict[str, Any], snapshots: List[Snapshot]
+            ) -> List[Snapshot]:
+        # Drop the snapshots that have left the query's time ranges
+        now = datetime.now(timezone.utc)
+        for k, v in params.items():
+            field = RANGE_FIELDS.get(k.lower())
+            if not field or v is None:
+                continue
+            low, high = parse_range(v, lambda t: parse_time(t, now))
+
+            def inside(value: datetime) -> bool:
+                if value is None:
+                    return True # unknown: kept
+                moment = value.timestamp()
+                return ((low is None or moment >= low)
+                        and (high is None or moment <= high))
+
+            snapshots = [snapshot for snapshot in snapshots
+                         if inside(getattr(snapshot, field))]
+
+        return snapshots
+
+    @staticmethod
+    def _format(value: datetime) -> str:
+        value = value.astimezone(timezone.utc)
+        return f"{value:%Y-%m-%dT%H:%M:%S}.{value.microsecond // 1000:03d}Z"
+
+    def _load(self, filename: str):
+        try:
+            with open(filename) as f:
+                state = json.load(f)
+            snapshots = Snapshot.Schema(many=True).load(state['snapshots'])
+            return state['mark'], snapshots
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"WARNING: bad search state '{filename}' ({e})")
+
+        return None, []
+
+    def _save(self, filename: str, snapshots: List[Snapshot]) -> None:
+        dates = [snapshot.ingestion_date for snapshot in snapshots
+                 if snapshot.ingestion_date]
+        state = {
+            'mark': self._format(max(dates)) if dates else None,
+            'snapshots': Snapshot.Schema(many=True).dump(snapshots)
+        }
+        temp = f"{filename}.tmp"
+        with open(temp, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp, filename)
+
+        return None
@@ -1,10 +1,130 @@
 import os
 import re
+import json
+import time
+import queue
+import random
+import threading
 import requests
 
+from typing import Any, Callable, List, Set, Tuple
+
 from .config import Config
 
-def download(source: str, config: Config, chunk_size=524288, index=None) -> str:
+# Byte range fetched (and resumed) as a whole by one connection
+SEGMENT_SIZE = 33554432
+
+
+def download_segments(source: str, target: str, filesize: int,
+        auth: Tuple[str, str] = None, connections: int = 4,
+        chunk_size: int = 524288, segment_size: int = SEGMENT_SIZE,
+        session: Any = requests, retries: int = 3,
+        progress: Callable[[int], int] = None) -> str:
+    # Fetch byte ranges over several connections into a preallocated
+    # '<target>.part'; completed segments are journaled to
+    # '<target>.part.json', so an interrupted download resumes with the
+    # unfinished ranges only. The file is renamed to target when complete
+    part = f"{target}.part"
+    state = f"{part}.json"
+    segments = [(start, min(start + segment_size, filesize) - 1)
+                for start in range(0, filesize, segment_size)]
+    done: Set[int] = set()
+    if os.path.exists(part) and os.path.exists(state):
+        try:
+            with open(state) as f:
+                journal = json.load(f)
+            if journal['size'] == filesize:
+                done = set(journal['done'])
+        except (ValueError, KeyError):
+            pass
+    if not done or os.stat(part).st_size != filesize:
+        done = set()
+        with open(part, 'wb') as f:
+            f.truncate(filesize)
+
+    lock = threading.Lock()
+    pending = queue.Queue()
+    for index in range(len(segments)):
+        if index not in done:
+            pending.put(index)
+    downloaded = [sum(segments[i][1] - segments[i][0] + 1 for i in done)]
+    completed = [0]
+    errors: List[Exception] = []
+
+    def report(size: int) -> None:
+        with lock:
+            downloaded[0] += size
+            percent = int(downloaded[0] / max(filesize, 1) * 100)
+            if progress and percent > completed[0]:
+                completed[0] = progress(percent)
+
+    def fetch(index: int) -> None:
+        start, end = segments[index]
+        r = session.get(source, auth=auth, stream=True,
+                        headers={'Range': f"bytes={start}-{end}"})
+        r.raise_for_status()
+        if r.status_code != 206 and (start > 0 or end < filesize - 1):
+            raise IOError("server ignored the byte range request")
+        written = 0
+        try:
+            with open(part, 'r+b') as f:
+                f.seek(start)
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        f.write(chunk)
+                        written += len(chunk)
+                        report(len(chunk))
+        except Exception:
+            report(-written)
+            raise
+        if written != end - start + 1:
+            report(-written)
+            raise IOError(f"short read {written} of {end - start + 1}")
+
+    def work() -> None:
+        while True:
+            try:
+                index = pending.get_nowait()
+            except queue.Empty:
+                break
+            for attempt in range(retries + 1):
+                try:
+                    fetch(index)
+                    break
+                except Exception as e:
+                    if attempt == retries:
+                        with lock:
+                            errors.append(e)
+                        return None
+                    # Interrupted stream: back off (with jitter) and resume
+                    time.sleep(random.uniform(0, 2 ** attempt))
+            with lock:
+                done.add(index)
+                with open(state, 'w') as f:
+                    json.dump({'size': filesize, 'done': sorted(done)}, f)
+
+    if progress:
+        progress(completed[0])
+    threads = [threading.Thread(target=work, daemon=True)
+               for _ in range(max(1, min(connections, pending.qsize())))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    os.replace(part, target)
+    try:
+        os.remove(state)
+    except FileNotFoundError:
+        pass
+
+    return target
+
+
+def download(source: str, config: Config, chunk_size=524288, index=None,
+        session: Any = None) -> str:
     def progress(percent: int) -> int:
         if config.verbose:
             if percent == 100:
@@ -21,16 +141,15 @@ def download(source: str, config: Config, chunk_size=524288, index=None) -> str:
         if not os.path.exists(config.output):
             os.makedirs(config.output)
 
-        r = requests.get(source, auth=(config.username, config.password),
-                         stream=True)
+        session = session or requests
+        r = session.get(source, auth=(config.username, config.password),
+                        headers={'Range': 'bytes=0-0'}, stream=True)
         r.raise_for_status()
         d = r.headers['content-disposition']
 
         filename = re.findall('filename="(.+)"', d)[0]
         filesize = int(re.findall('/(.+)', r.headers['content-range'])[0])
-
-        downloaded = 1
-        completed = 0
+        r.close()
 
         prefix = '\n{0:3d} '.format(index) if type(index) is int else '\n'
         print(f'{prefix}{filename}')
@@ -39,16 +158,11 @@ def download(source: str, config: Config, chunk_size=524288, index=None) -> str:
         if os.path.exists(target) and os.stat(target).st_size == filesize:
             print(f'File already exists. Skipping...')
             return filename
-        with open(target, 'wb') as f:
-            progress(0)
-            for chunk in r.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    percent = int(downloaded / filesize * 100)
-                    if percent > completed:
-                        completed = progress(percent)
-            f.flush()
+        download_segments(source, target, filesize,
+                          auth=(config.username, config.password),
+                          connections=config.connections,
+                          chunk_size=chunk_size, session=session,
+                          progress=progress)
     except Exception as ex:
         print(f'\n{type(ex).__name__}', ex.args)
         print(ex)
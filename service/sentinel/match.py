@@ -0,0 +1,118 @@
+import numpy as np
+
+from datetime import timedelta
+from typing import Any, List, Sequence, Tuple, Union
+
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from .model import Snapshot
+from .table import MICROSECOND, NAT, SnapshotTable, to_epoch
+
+
+Snapshots = Union[Sequence[Snapshot], SnapshotTable]
+Pair = Tuple[Snapshot, Snapshot, timedelta]
+
+
+def get_epochs(snapshots: Snapshots, field: str) -> np.ndarray:
+    if isinstance(snapshots, SnapshotTable):
+        return snapshots.columns[field]
+
+    return np.array([to_epoch(getattr(snapshot, field))
+                     for snapshot in snapshots], dtype=np.int64)
+
+
+def expand(starts: np.ndarray, stops: np.ndarray
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    # Row i and each position of [starts[i], stops[i]) as flat index arrays
+    counts = np.maximum(stops - starts, 0)
+    rows = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    positions = (np.repeat(starts - offsets[:-1], counts)
+                 + np.arange(offsets[-1], dtype=np.int64))
+
+    return rows, positions
+
+
+def query_tree(tree: STRtree, index: dict, geometry: Any) -> List[int]:
+    # Positions of the tree geometries whose envelopes meet the geometry's
+    # (Shapely < 2 returns geometries from query(), later versions indices;
+    # index maps id(tree geometry) -> position)
+    found = tree.query(geometry)
+
+    return [int(item) if isinstance(item, (int, np.integer))
+            else index[id(item)] for item in found]
+
+
+def intersecting(left: Snapshots, right: Snapshots
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    # Footprint pairs that intersect: an STR-tree over the right side,
+    # exact tests with the prepared left footprint
+    geometries = [(j, snapshot.polygon) for j, snapshot in enumerate(right)
+                  if snapshot.polygon is not None]
+    rows: List[int] = []
+    columns: List[int] = []
+    if not geometries:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    tree = STRtree([geometry for _, geometry in geometries])
+    index = {id(geometry): n for n, (_, geometry) in enumerate(geometries)}
+    for i, snapshot in enumerate(left):
+        if snapshot.polygon is None:
+            continue
+        polygon = prep(snapshot.polygon)
+        for n in query_tree(tree, index, snapshot.polygon):
+            j, geometry = geometries[n]
+            if polygon.intersects(geometry):
+                rows.append(i)
+                columns.append(j)
+
+    return np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64)
+
+
+def match_nearest(left: Snapshots, right: Snapshots, k: int = 1,
+        max_delta: timedelta = None, intersects: bool = False,
+        field: str = 'begin_position') -> List[Pair]:
+    # Pairs (left, right, time difference) ordered by the difference: the k
+    # nearest ones, or all within max_delta (k=None), or the k nearest
+    # within max_delta. The right side is sorted once and searched by
+    # bisection, so no product of both sides is built. With intersects set
+    # only pairs with intersecting footprints are taken
+    if k is None and max_delta is None:
+        raise ValueError("either k or max_delta must be given")
+    times_left = get_epochs(left, field)
+    times_right = get_epochs(right, field)
+    if intersects:
+        rows, columns = intersecting(left, right)
+        deltas = np.abs(times_left[rows] - times_right[columns])
+        valid = (times_left[rows] != NAT) & (times_right[columns] != NAT)
+        if max_delta is not None:
+            valid &= deltas <= max_delta // MICROSECOND
+        rows, columns, deltas = rows[valid], columns[valid], deltas[valid]
+    else:
+        rows = np.flatnonzero(times_left != NAT)
+        valid = np.flatnonzero(times_right != NAT)
+        order = valid[np.argsort(times_right[valid], kind='mergesort')]
+        ordered = times_right[order]
+        times = times_left[rows]
+        if max_delta is not None:
+            width = max_delta // MICROSECOND
+            starts = np.searchsorted(ordered, times - width, side='left')
+            stops = np.searchsorted(ordered, times + width, side='right')
+        else:
+            # The k nearest pairs overall are among the k nearest right
+            # snapshots of each left one: k on both sides of its position
+            positions = np.searchsorted(ordered, times)
+            starts = np.maximum(positions - k, 0)
+            stops = np.minimum(positions + k, len(ordered))
+        found, positions = expand(starts, stops)
+        rows, columns = rows[found], order[positions]
+        deltas = np.abs(times_left[rows] - times_right[columns])
+    if k is not None and len(deltas) > k:
+        best = np.argpartition(deltas, k - 1)[:k]
+        rows, columns, deltas = rows[best], columns[best], deltas[best]
+    order = np.lexsort((columns, rows, deltas))
+
+    return [(left[int(rows[i])], right[int(columns[i])],
+             timedelta(microseconds=int(deltas[i]))) for i in order]
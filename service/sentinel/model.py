@@ -2,11 +2,11 @@ import os
 import json, yaml
 import marshmallow as mm
 
-from datetime import datetime
+from datetime import datetime, timezone
 from dataclasses import dataclass
-from typing import Tuple
+from typing import Tuple, Union
 
-from shapely import wkt
+from shapely import wkb, wkt
 from shapely.geometry import GeometryCollection, Polygon, shape
 
 
@@ -100,11 +100,31 @@ class PolygonField(mm.fields.Field):
 
         return str(value)
 
-    def _deserialize(self, value: str, *args, **kwargs) -> Polygon:
+    def _deserialize(self, value: str, *args, **kwargs) -> str:
         if not isinstance(value, (str, bytes)):
             raise self.make_error("invalid")
 
-        return wkt.loads(value)
+        if isinstance(value, bytes):
+            value = value.decode()
+
+        return value # WKT, parsed by Snapshot.polygon on first access
+
+
+def parse_datetime(value: str) -> datetime:
+    # Fast path for hub timestamps 'YYYY-MM-DDTHH:MM:SS[.ffffff]Z'
+    # (ValueError for anything else)
+    if value is None:
+        return None
+    if len(value) < 20 or value[10] != 'T' or value[-1] != 'Z':
+        raise ValueError(f"unsupported timestamp '{value}'")
+    fraction = value[19:-1]
+    if fraction and (fraction[0] != '.' or not fraction[1:].isdigit()):
+        raise ValueError(f"unsupported timestamp '{value}'")
+
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                    int(fraction[1:7].ljust(6, '0')) if fraction else 0,
+                    tzinfo=timezone.utc)
 
 
 @dataclass
@@ -122,17 +142,19 @@ class Snapshot:
     instrument: str
 
     class Schema(mm.Schema):
+        # Fields a hub entry may lack are nullable, as in the direct
+        # construction of DataHub.compose_snapshot()
         uuid = mm.fields.Str()
         link = mm.fields.Str()
-        icon = mm.fields.Str()
-        size = mm.fields.Str()
+        icon = mm.fields.Str(allow_none=True)
+        size = mm.fields.Str(allow_none=True)
         title = mm.fields.Str()
-        polygon = PolygonField()
-        begin_position = mm.fields.AwareDateTime()
-        end_position = mm.fields.AwareDateTime()
-        ingestion_date = mm.fields.AwareDateTime()
+        polygon = PolygonField(allow_none=True)
+        begin_position = mm.fields.AwareDateTime(allow_none=True)
+        end_position = mm.fields.AwareDateTime(allow_none=True)
+        ingestion_date = mm.fields.AwareDateTime(allow_none=True)
         cloud_coverage = mm.fields.Float(allow_none=True)
-        instrument = mm.fields.Str()
+        instrument = mm.fields.Str(allow_none=True)
 
         @mm.post_load
         def make_object(self, data, **kwargs):
@@ -140,3 +162,26 @@ class Snapshot:
 
     def __str__(self):
         return json.dumps(self.Schema().dump(self), indent=2)
+
+
+def _get_polygon(self: Snapshot) -> Polygon:
+    # Footprints are kept as WKT (or WKB) until first used
+    polygon = self.__dict__['_polygon']
+    if isinstance(polygon, str):
+        polygon = wkt.loads(polygon)
+        self.__dict__['_polygon'] = polygon
+    elif isinstance(polygon, bytes):
+        polygon = wkb.loads(polygon)
+        self.__dict__['_polygon'] = polygon
+
+    return polygon
+
+
+def _set_polygon(self: Snapshot, value: Union[Polygon, str]) -> None:
+    self.__dict__['_polygon'] = value
+
+    return None
+
+
+# Set after the dataclass is built (a class attribute would be a default)
+Snapshot.polygon = property(_get_polygon, _set_polygon)
@@ -1,23 +1,33 @@
 import os
 import re
 import math
-import time
 import requests
 
 from pprint import pprint # DEBUG
+from concurrent.futures import ThreadPoolExecutor
 from json.decoder import JSONDecodeError
 from typing import Any, Dict, List, Union
 
 from .config import Config
-from .model import Snapshot
+from .download import download_segments
+from .session import create_session
+from .model import Snapshot, parse_datetime
 
 
 class DataHub:
     def __init__(self, config: Config, limit: int = None,
-            chunk_size: int = 45, url: str = None) -> List[Dict]:
+            chunk_size: int = 45, url: str = None,
+            concurrency: int = 4, pool_size: int = 16, retries: int = 5,
+            backoff: float = 1.0) -> List[Dict]:
         self.max_iterations = limit # 1000
         self.max_downloaded = limit
+        self.concurrency = concurrency # parallel page requests
+        # Keep-alive connections shared by search and download
+        self.session = create_session(pool_size, retries, backoff)
         self.snapshots: List[Snapshot] = None
+        self.complete = True # the last search got every page it asked for
+        self.catalog = None # local catalog filled with search results
+        self.schema = Snapshot.Schema() # reused (fallback decoding)
         self.chunk_size = chunk_size
         self.config = config
         if not url:
@@ -26,6 +36,7 @@ class DataHub:
             self.url = url
 
     def search(self, params: Dict[str, Any], area=None) -> List[Snapshot]:
+        self.complete = False
         if not self.config.has_credentials:
             print(f"No credentials!")
             return []
@@ -48,112 +59,158 @@ class DataHub:
         if self.config.verbose:
             print("\nStarting a new search...")
 
-        snapshots: List[Snapshot] = []
-
-        # Create 'filenames' list
+        # Create 'filenames' chunks (one request each)
         if 'filenames' in params and type(params['filenames']) is list:
-            filenames = params['filenames']
+            filenames = list(self._split(params['filenames']))
         else:
             filenames = []
         # if filenames:
             # print(f"Splitting 'filenames' by {self.chunk_size} items...")
             # params['rows'] = self.chunk_size
+        params['filenames'] = filenames[0] if filenames else []
+        params.setdefault('start', 0)
+        rows = params.get('rows', 100)
+        digits = math.ceil(math.log10(max(self.max_iterations,
+                                          len(params['filenames'])))) + 1
 
-        # Create 'filenames' generator from the list
-        filenames = self._split(filenames)
+        # The first page tells the total, then the rest is fetched
+        # concurrently (and assembled in order)
+        feed = self._fetch(params)
         try:
-            params['filenames'] = next(filenames)
-        except StopIteration:
-            # Start with zero generator from empty list
-            params['filenames'] = []
-        total_items = 0 # for page splitting
+            total_items = int(feed['opensearch:totalResults'])
+        except (TypeError, KeyError, ValueError):
+            total_items = 0
+        # Results past the limits are left out: the search is not complete
+        capped = False
+        if filenames:
+            pages = [dict(params, filenames=chunk, start=0)
+                     for chunk in filenames[1:]]
+        else:
+            last = min(total_items, params['start'] + self.max_downloaded)
+            capped = total_items > params['start'] + self.max_downloaded
+            pages = [dict(params, start=start)
+                     for start in range(params['start'] + rows, last, rows)]
+        if len(pages) > max(self.max_iterations - 1, 0):
+            capped = True
+        pages = pages[:max(self.max_iterations - 1, 0)]
+        feeds = [feed]
+        if feed is not None and pages:
+            workers = max(1, min(self.concurrency, len(pages)))
+            with ThreadPoolExecutor(workers) as pool:
+                feeds += list(pool.map(self._fetch, pages))
+
+        snapshots: List[Snapshot] = []
         total_found = 0 # for chunk splitting
-        digits = math.ceil(math.log10(max(self.max_iterations,
-                                          len(params['filenames'])))) + 1
-        for i in range(self.max_iterations):
-            #
-            # Get response (retry by max_iterations, break by error)
-            #
-            try:
-                params_ = OpenSearchAPI.get_api_params(params)
-                r = requests.get(
-                    url = self.url,
-                    params = params_,
-                    auth=(self.config.username, self.config.password)
-                )
-                r.raise_for_status()
-            except requests.exceptions.HTTPError as e:
-                if self.config.verbose:
-                    print(type(e).__name__, '\n'.join(e.args))
-                break
-            except requests.exceptions.RequestException as e:
-                if self.config.verbose:
-                    print(type(e).__name__, '\n'.join(e.args))
-                    print("No connection, taking a timeout...")
-                time.sleep(2)
-                continue
-
-            #
-            # Parse response (must be JSON format)
-            #
+        complete = not capped
+        for page, feed in zip([params] + pages, feeds):
+            if feed is None:
+                complete = False
+                break # keep results contiguous (as the page walk did)
             try:
-                items = r.json()['feed']['entry']
-                if not total_items:
-                    total_items = int(
-                        r.json()['feed']['opensearch:totalResults']
-                    )
+                items = feed['entry']
 
                 # Fill 'snapshots' with search results
+                if isinstance(items, dict):
+                    items = [items]
                 if isinstance(items, list):
                     for item in items:
                         snapshots.append(self.compose_snapshot(item))
-                elif isinstance(items, dict):
-                    snapshots.append(self.compose_snapshot(items))
                 else:
                     raise ValueError(f"bad feed entry type {type(items)}")
 
                 if self.config.verbose:
-                    # TODO: check params['start'] or total_found must be 0
-                    print(f"{(params['start'] + total_found):+{digits}d}:",
+                    print(f"{(page['start'] + total_found):+{digits}d}:",
                           f"{len(items)} records out of",
                           f"{total_items} fetched")
-
-                # Either increment page start index or get next chunk
-                if params['filenames']:
-                    try:
-                        total_found += len(items)
-                        params['filenames'] = next(filenames)
-                        params['start'] = 0 # TODO: check use cases
-                    except StopIteration:
-                        raise KeyError # FIXME: do better stop signalling
-                else:
-                    params['start'] += params['rows']
-
-                if len(snapshots) >= self.max_downloaded:
-                    break
+                if page['filenames']:
+                    total_found += len(items)
             except KeyError:
                 if self.config.verbose:
                     print("No more results...")
                 break
-            except JSONDecodeError:
-                if self.config.verbose:
-                    print(f"Bad JSON response:")
-                    pprint(r.text)
-                break
             except ValueError as e:
                 print(f"ERROR: {e}\n")
+                complete = False
                 break
 
         self.snapshots = snapshots
+        self.complete = complete
+        if self.catalog is not None and snapshots:
+            self.catalog.add(snapshots, params)
 
         return self.snapshots
 
+    def _fetch(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        # Get one page of the response feed (connection errors, 429 and 5xx
+        # are retried with backoff by the session; give up on HTTP errors
+        # and bad JSON)
+        #
+        # Get response
+        #
+        try:
+            params_ = OpenSearchAPI.get_api_params(params)
+            r = self.session.get(
+                url = self.url,
+                params = params_,
+                auth=(self.config.username, self.config.password)
+            )
+            r.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            if self.config.verbose:
+                print(type(e).__name__, '\n'.join(map(str, e.args)))
+            return None
+        except requests.exceptions.RequestException as e:
+            if self.config.verbose:
+                print(type(e).__name__, '\n'.join(map(str, e.args)))
+                print("No connection, giving up...")
+            return None
+
+        #
+        # Parse response (must be JSON format)
+        #
+        try:
+            return r.json()['feed']
+        except JSONDecodeError:
+            if self.config.verbose:
+                print(f"Bad JSON response:")
+                pprint(r.text)
+            return None
+        except KeyError:
+            return None
+
     def _split(self, source: List[Any]):
         items = self.chunk_size
         for i in range(0, len(source), items):
             yield source[i:i + items]
 
     def compose_snapshot(self, response: Dict[str, Any]) -> Snapshot:
+        # Direct construction: each field list is indexed once, footprints
+        # stay WKT until used; the schema handles entries it can't decode
+        try:
+            strs = self._index(response['str'], 'name', 'content')
+            dates = self._index(response['date'], 'name', 'content')
+            links = self._index(response['link'], 'rel', 'href')
+            doubles = self._index(response.get('double', []), 'name',
+                                  'content')
+            cloud_coverage = doubles.get('cloudcoverpercentage')
+            return Snapshot(
+                uuid=response['id'],
+                link=response['link'][0]['href'],
+                icon=links.get('icon'),
+                size=strs.get('size'),
+                title=response['title'],
+                polygon=strs.get('footprint'),
+                begin_position=parse_datetime(dates.get('beginposition')),
+                end_position=parse_datetime(dates.get('endposition')),
+                ingestion_date=parse_datetime(dates.get('ingestiondate')),
+                cloud_coverage=(float(cloud_coverage)
+                                if cloud_coverage is not None else None),
+                instrument=strs.get('instrumentshortname')
+            )
+        except (KeyError, IndexError, TypeError, ValueError):
+            return self.compose_snapshot_schema(response)
+
+    def compose_snapshot_schema(self, response: Dict[str, Any]) -> Snapshot:
         cloud_coverage = None
         if 'double' in response:
             doubles = response['double']
@@ -161,7 +218,7 @@ class DataHub:
                 doubles = [doubles]
             cloud_coverage = self.get_param(doubles, 'cloudcoverpercentage')
 
-        return Snapshot.Schema().load(dict(
+        return self.schema.load(dict(
             uuid=response['id'],
             link=response['link'][0]['href'],
             icon=self.get_param(response['link'], 'icon'),
@@ -175,6 +232,14 @@ class DataHub:
             instrument=self.get_param(response['str'], 'instrumentshortname'),
         ))
 
+    @staticmethod
+    def _index(fields: Any, key: str, value: str) -> Dict[str, Any]:
+        # Name -> content of a feed field list (the first one wins)
+        if isinstance(fields, dict):
+            fields = [fields]
+
+        return {field.get(key): field.get(value) for field in reversed(fields)}
+
     def get_param(self, fields: List[Dict[str, Any]], param_name: str) -> Any:
         for field in fields:
             if field.get('name') == param_name:
@@ -184,7 +249,8 @@ class DataHub:
 
         return None
 
-    def _download(self, source: str, chunk_size=524288, index=None) -> str:
+    def _download(self, source: str, chunk_size=524288, index=None,
+            output: str = None) -> str:
         def progress(percent: int) -> int:
             if self.config.verbose:
                 if percent == 100:
@@ -196,23 +262,23 @@ class DataHub:
             return percent
 
         filename: str = None
+        output = output or self.config.output
 
         try:
-            assert self.config.output, "Can't download with no output!"
-            if not os.path.exists(self.config.output):
-                os.makedirs(self.config.output)
-
-            r = requests.get(source, auth=(self.config.username,
-                                           self.config.password),
-                             stream=True)
+            assert output, "Can't download with no output!"
+            if not os.path.exists(output):
+                os.makedirs(output)
+
+            # Probe the first byte for the file name and size
+            r = self.session.get(source, auth=(self.config.username,
+                                               self.config.password),
+                                 headers={'Range': 'bytes=0-0'}, stream=True)
             r.raise_for_status()
             d = r.headers['content-disposition']
 
             filename = re.findall('filename="(.+)"', d)[0]
             filesize = int(re.findall('/(.+)', r.headers['content-range'])[0])
-
-            downloaded = 1
-            completed = 0
+            r.close()
 
             if self.config.verbose:
                 if type(index) is int:
@@ -221,22 +287,19 @@ class DataHub:
                     prefix = f"\n"
                 print(f"{prefix}{filename}")
 
-            target = os.path.join(self.config.output, filename)
+            target = os.path.join(output, filename)
             if os.path.exists(target) and os.stat(target).st_size == filesize:
                 if self.config.verbose:
                     print(f"File already exists. Skipping...")
                 return filename
 
-            with open(target, 'wb') as f:
-                progress(0)
-                for chunk in r.iter_content(chunk_size=chunk_size):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        percent = int(downloaded / filesize * 100)
-                        if percent > completed:
-                            completed = progress(percent)
-                f.flush()
+            # Parallel byte ranges, resumed from '<target>.part' if any
+            download_segments(source, target, filesize,
+                              auth=(self.config.username,
+                                    self.config.password),
+                              connections=self.config.connections,
+                              session=self.session,
+                              chunk_size=chunk_size, progress=progress)
         except Exception as ex:
             if self.config.verbose:
                 print(f"\n{type(ex).__name__}", ex.args)
@@ -246,7 +309,7 @@ class DataHub:
         return filename
 
     Sources = Union[int, List[int], str, List[str], Snapshot, List[Snapshot]]
-    def download(self, sources: Sources) -> List[str]:
+    def download(self, sources: Sources, output: str = None) -> List[str]:
         files = []
 
         if not isinstance(self.snapshots, List):
@@ -262,17 +325,18 @@ class DataHub:
                         source = self[i]
                     else:
                         continue
-                files.append(self._download(source, index=i))
+                files.append(self._download(source, index=i, output=output))
         else:
             source = sources
             if isinstance(source, int):
                 if source < len(self):
                     source = self[source].download_link
-                    files.append(self._download(source, index=sources))
+                    files.append(self._download(source, index=sources,
+                                                output=output))
             else:
                 if isinstance(source, Snapshot):
                     source = source.link
-                files.append(self._download(source))
+                files.append(self._download(source, output=output))
 
         return files
 
@@ -0,0 +1,33 @@
+import random
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class JitteredRetry(Retry):
+    # Exponential backoff with full jitter, so that concurrent clients do not
+    # retry in lockstep ('Retry-After' of 429/503 still takes precedence)
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
+
+def create_session(pool_size: int = 16, retries: int = 5,
+        backoff: float = 1.0) -> requests.Session:
+    # Shared keep-alive session: connections are pooled per host and reused
+    # by search and download requests
+    retry = JitteredRetry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
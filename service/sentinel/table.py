@@ -0,0 +1,231 @@
+import numpy as np
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterator, List, Sequence, Tuple, Union
+
+from shapely import wkb
+
+from .model import Snapshot
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+NAT = np.iinfo(np.int64).min # missing time
+
+TIMES = ('begin_position', 'end_position', 'ingestion_date')
+TEXTS = ('link', 'icon', 'size', 'title', 'instrument')
+
+WKB_ORDERS = (b'\x00', b'\x01') # first byte of WKB (WKT starts with a letter)
+
+
+def to_epoch(value: datetime) -> int:
+    # Microseconds since the epoch (naive times are taken as UTC)
+    if value is None:
+        return NAT
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+
+    return (value - EPOCH) // MICROSECOND
+
+
+def from_epoch(value: int) -> datetime:
+    if value == NAT:
+        return None
+
+    return EPOCH + timedelta(microseconds=int(value))
+
+
+def get_footprint(snapshot: Snapshot) -> bytes:
+    # The footprint as the snapshot holds it, not parsed: WKT text as is,
+    # WKB for geometries already parsed
+    polygon = snapshot.__dict__.get('_polygon')
+    if polygon is None or isinstance(polygon, bytes):
+        return polygon
+    if isinstance(polygon, str):
+        return polygon.encode()
+
+    return wkb.dumps(polygon)
+
+
+def to_footprint(value: bytes) -> Union[bytes, str]:
+    # Packed footprint -> WKB bytes or WKT text (parsed on first access)
+    if value is None or value[:1] in WKB_ORDERS:
+        return value
+
+    return value.decode()
+
+
+class Packed:
+    # Variable length byte strings in one buffer (None is kept apart from
+    # b'' by a mask): a column without a Python object per row
+    def __init__(self, data: np.ndarray, offsets: np.ndarray,
+            valid: np.ndarray) -> None:
+        self.data = data # uint8
+        self.offsets = offsets # int64, one more than rows
+        self.valid = valid # bool
+
+    @classmethod
+    def pack(cls, values: Sequence[bytes]) -> 'Packed':
+        valid = np.array([value is not None for value in values], dtype=bool)
+        lengths = np.array([len(value) if value is not None else 0
+                            for value in values], dtype=np.int64)
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        buffer = b''.join(value for value in values if value is not None)
+        data = np.frombuffer(buffer, dtype=np.uint8).copy() if buffer \
+               else np.zeros(0, dtype=np.uint8)
+
+        return cls(data, offsets, valid)
+
+    def take(self, indices: np.ndarray) -> 'Packed':
+        # Vectorized gather of the selected rows into a new buffer
+        starts = self.offsets[:-1][indices]
+        lengths = (self.offsets[1:] - self.offsets[:-1])[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = (np.repeat(starts - offsets[:-1], lengths)
+                     + np.arange(offsets[-1], dtype=np.int64))
+
+        return Packed(self.data[positions], offsets, self.valid[indices])
+
+    def __getitem__(self, index: int) -> bytes:
+        if not self.valid[index]:
+            return None
+
+        return self.data[self.offsets[index]:self.offsets[index + 1]] \
+                   .tobytes()
+
+    def __len__(self) -> int:
+        return len(self.valid)
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.offsets.nbytes + self.valid.nbytes
+
+
+class SnapshotTable:
+    # Columnar search results: times as int64 epoch microseconds, cloud
+    # coverage as float32 (NaN if unknown), UUIDs as fixed width bytes, other
+    # strings and footprints (WKT or WKB, never parsed here) packed into
+    # byte buffers. Sort, filter and deduplication run on the arrays,
+    # Snapshot objects are made on demand
+    def __init__(self, columns: dict) -> None:
+        self.columns = columns
+
+    @classmethod
+    def from_snapshots(cls, snapshots: Sequence[Snapshot]
+            ) -> 'SnapshotTable':
+        columns = {
+            'uuid': np.array([snapshot.uuid.encode()
+                              for snapshot in snapshots], dtype=bytes),
+            'cloud_coverage': np.array([
+                snapshot.cloud_coverage
+                if snapshot.cloud_coverage is not None else np.nan
+                for snapshot in snapshots
+            ], dtype=np.float32),
+            'polygon': Packed.pack([get_footprint(snapshot)
+                                    for snapshot in snapshots])
+        }
+        for name in TIMES:
+            columns[name] = np.array([to_epoch(getattr(snapshot, name))
+                                      for snapshot in snapshots],
+                                     dtype=np.int64)
+        for name in TEXTS:
+            columns[name] = Packed.pack([
+                value.encode() if value is not None else None
+                for value in (getattr(snapshot, name)
+                              for snapshot in snapshots)
+            ])
+
+        return cls(columns)
+
+    def take(self, indices: np.ndarray) -> 'SnapshotTable':
+        indices = np.asarray(indices, dtype=np.int64)
+
+        return SnapshotTable({name: column.take(indices)
+                              if isinstance(column, Packed)
+                              else column[indices]
+                              for name, column in self.columns.items()})
+
+    def sort(self, key: str = 'begin_position',
+            reverse: bool = False) -> 'SnapshotTable':
+        # Stable, as sorted() was (missing times go first)
+        column = self.columns[key]
+        if reverse:
+            order = np.argsort(-column.astype(np.float64)
+                               if column.dtype.kind == 'f'
+                               else ~column, kind='mergesort')
+        else:
+            order = np.argsort(column, kind='mergesort')
+
+        return self.take(order)
+
+    def where(self, cloud_coverage: Tuple[float, float] = None,
+            **ranges: Tuple[datetime, datetime]) -> 'SnapshotTable':
+        # Rows within [low, high] of each given column (None for open ends):
+        # where(cloud_coverage=(0, 50), begin_position=(start, None))
+        mask = np.ones(len(self), dtype=bool)
+        if cloud_coverage is not None:
+            low, high = cloud_coverage
+            column = self.columns['cloud_coverage']
+            mask &= ~np.isnan(column)
+            if low is not None:
+                mask &= column >= low
+            if high is not None:
+                mask &= column <= high
+        for name, (low, high) in ranges.items():
+            if name not in TIMES:
+                raise ValueError(f"unknown time column '{name}'")
+            column = self.columns[name]
+            mask &= column != NAT
+            if low is not None:
+                mask &= column >= to_epoch(low)
+            if high is not None:
+                mask &= column <= to_epoch(high)
+
+        return self.take(np.flatnonzero(mask))
+
+    def unique(self) -> 'SnapshotTable':
+        # First occurrence of every UUID, order kept
+        _, first = np.unique(self.columns['uuid'], return_index=True)
+
+        return self.take(np.sort(first))
+
+    def snapshot(self, index: int) -> Snapshot:
+        columns = self.columns
+        cloud_coverage = columns['cloud_coverage'][index]
+        texts = {name: columns[name][index] for name in TEXTS}
+
+        return Snapshot(
+            uuid=columns['uuid'][index].decode(),
+            polygon=to_footprint(columns['polygon'][index]),
+            cloud_coverage=(None if np.isnan(cloud_coverage)
+                            else float(cloud_coverage)),
+            **{name: from_epoch(columns[name][index]) for name in TIMES},
+            **{name: value.decode() if value is not None else None
+               for name, value in texts.items()}
+        )
+
+    def __getitem__(self, index: Union[int, slice, np.ndarray]) -> Any:
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('snapshot index out of range')
+            return self.snapshot(index)
+
+        return self.take(np.arange(len(self))[index])
+
+    def __iter__(self) -> Iterator[Snapshot]:
+        for index in range(len(self)):
+            yield self.snapshot(index)
+
+    def __len__(self) -> int:
+        return len(self.columns['uuid'])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self.columns.values())
+
+    def to_list(self) -> List[Snapshot]:
+        return list(self)
@@ -0,0 +1,203 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+from dataclasses import asdict, dataclass
+from osgeo import gdal
+from typing import Any, Dict, List, Tuple
+
+from raster import BLOCK_PIXELS, Window, iter_windows
+
+
+# Two-sided 95% normal quantile of the error bounds
+Z_95: float = 1.96
+
+STATS_MODES: Tuple[str, ...] = ('exact', 'sampled', 'overview')
+
+
+@dataclass
+class Stats:
+    mean: float
+    std: float
+    count: int # pixels the statistics were taken from (nodata excluded)
+    error_mean: float # ~95% bound of |mean - exact mean| (0 when exact)
+    error_std: float # ~95% bound of |std - exact std|
+    mode: str
+
+    def clip(self, deviations: float = 2.0) -> np.float32:
+        return np.float32(self.mean + deviations * self.std)
+
+    def error_clip(self, deviations: float = 2.0) -> float:
+        return self.error_mean + deviations * self.error_std
+
+
+def get_sums(image: np.ndarray, nodata: float = None
+        ) -> Tuple[int, float, float]:
+    # (count, sum, sum of squares) of the valid pixels
+    if nodata is not None:
+        image = image[image != nodata]
+    image = image.astype(np.float64, copy=False)
+
+    return image.size, float(image.sum()), float(np.dot(image.ravel(),
+                                                         image.ravel()))
+
+
+def estimate(sums: np.ndarray, clusters: int, mode: str) -> Stats:
+    # Ratio estimator over sampled clusters (rows: count, sum, squares) of
+    # a band split into `clusters` ones (None: not a whole-cluster sample,
+    # no finite population correction). The error bounds are the sampling
+    # errors of the mean of x and x^2, the std one linearized from the
+    # variance
+    counts, totals, squares = sums[:, 0], sums[:, 1], sums[:, 2]
+    count = counts.sum()
+    if not count:
+        return Stats(0.0, 0.0, 0, 0.0, 0.0, mode)
+    mean = totals.sum() / count
+    moment = squares.sum() / count
+    std = float(np.sqrt(max(moment - mean ** 2, 0.0)))
+    n = len(sums)
+    if clusters is not None and n >= clusters:
+        return Stats(float(mean), std, int(count), 0.0, 0.0, mode)
+    if n < 2:
+        return Stats(float(mean), std, int(count), np.inf, np.inf, mode)
+    correction = 1 - n / clusters if clusters else 1.0
+    scale = np.sqrt(correction / (n * (n - 1))) / (count / n)
+    error_mean = Z_95 * scale * np.sqrt(np.square(totals - mean * counts)
+                                        .sum())
+    error_moment = Z_95 * scale * np.sqrt(np.square(squares - moment * counts)
+                                          .sum())
+    error_var = error_moment + 2 * abs(mean) * error_mean
+    error_std = (error_var / (2 * std) if std else np.sqrt(error_var))
+
+    return Stats(float(mean), std, int(count), float(error_mean),
+                 float(error_std), mode)
+
+
+class StatsProvider:
+    # Band statistics for the stretches: 'exact' reads the whole band
+    # window by window, 'sampled' a random subset of its native blocks
+    # (fraction of them, at least min_blocks) and 'overview' a decimated
+    # read of about max_pixels (GDAL takes an overview when the band has
+    # one, else nearest neighbour pixels, i.e. a strided read). Every
+    # result carries its ~95% error bounds and is cached per product and
+    # band: in memory and, with a path, on disk
+    def __init__(self, mode: str = 'exact', fraction: float = 0.02,
+            min_blocks: int = 64, max_pixels: int = 1048576,
+            path: str = None) -> None:
+        if mode not in STATS_MODES:
+            raise ValueError(f"unknown statistics mode '{mode}'")
+        self.mode = mode
+        self.fraction = fraction
+        self.min_blocks = min_blocks
+        self.max_pixels = max_pixels
+        self.path = path
+        self._stats: Dict[str, Stats] = {}
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    @property
+    def settings(self) -> Tuple[Any, ...]:
+        return (self.mode, self.fraction, self.min_blocks, self.max_pixels,
+                self.path)
+
+    @classmethod
+    def from_options(cls, options: Dict[str, Any]) -> 'StatsProvider':
+        if not options:
+            return None
+
+        return cls(options.get('mode', 'exact'),
+                   options.get('fraction', 0.02),
+                   options.get('min_blocks', 64),
+                   options.get('max_pixels', 1048576),
+                   options.get('path', None))
+
+    def get(self, band: gdal.Band, product: str, name: str,
+            nodata: float = None) -> Stats:
+        # Statistics of a band of a product (name tells the bands apart)
+        key = '_'.join([product, name, str(nodata)]
+                       + [str(value) for value in self.settings[:4]])
+        key = hashlib.sha1(key.encode()).hexdigest()
+        with self._lock:
+            if key in self._stats:
+                return self._stats[key]
+        stats = self._load(key)
+        if stats is None:
+            if self.mode == 'sampled':
+                stats = self.sample_blocks(band, nodata, int(key[:8], 16))
+            elif self.mode == 'overview':
+                stats = self.sample_overview(band, nodata)
+            else:
+                stats = self.read_exact(band, nodata)
+            self._save(key, stats)
+        with self._lock:
+            self._stats[key] = stats
+
+        return stats
+
+    @staticmethod
+    def read_exact(band: gdal.Band, nodata: float = None) -> Stats:
+        sums = [get_sums(band.ReadAsArray(*window), nodata)
+                for window in iter_windows(band, BLOCK_PIXELS)]
+
+        return estimate(np.array(sums, dtype=np.float64), len(sums), 'exact')
+
+    def sample_blocks(self, band: gdal.Band, nodata: float = None,
+            seed: int = 0) -> Stats:
+        # Whole native blocks (cheap to decode) picked at random, in file
+        # order; the seed comes from the key, so a product always gets the
+        # same sample
+        windows: List[Window] = list(iter_windows(band, 1))
+        n = min(len(windows), max(self.min_blocks,
+                                  int(np.ceil(self.fraction * len(windows)))))
+        picked = np.sort(np.random.RandomState(seed)
+                         .choice(len(windows), n, replace=False))
+        sums = [get_sums(band.ReadAsArray(*windows[i]), nodata)
+                for i in picked]
+
+        return estimate(np.array(sums, dtype=np.float64), len(windows),
+                        'sampled')
+
+    def sample_overview(self, band: gdal.Band, nodata: float = None
+            ) -> Stats:
+        # Rows of the decimated image are the clusters of the error bounds
+        # (right for a strided read; averaged overviews understate the std)
+        size_x, size_y = band.XSize, band.YSize
+        factor = max(1.0, np.sqrt(size_x * size_y / self.max_pixels))
+        buf_x = max(1, int(size_x / factor))
+        buf_y = max(1, int(size_y / factor))
+        whole = buf_x == size_x and buf_y == size_y # small band, all read
+        image = band.ReadAsArray(0, 0, size_x, size_y, buf_xsize=buf_x,
+                                 buf_ysize=buf_y,
+                                 resample_alg=gdal.GRIORA_NearestNeighbour)
+        sums = [get_sums(row, nodata) for row in image]
+
+        return estimate(np.array(sums, dtype=np.float64),
+                        len(sums) if whole else None, 'overview')
+
+    def _load(self, key: str) -> Stats:
+        if not self.path:
+            return None
+        filename = os.path.join(self.path, f"{key}.json")
+        try:
+            with open(filename, 'r') as f:
+                return Stats(**json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"WARNING: bad statistics '{filename}' ({e})")
+
+        return None
+
+    def _save(self, key: str, stats: Stats) -> None:
+        if not self.path:
+            return None
+        filename = os.path.join(self.path, f"{key}.json")
+        temp = os.path.join(self.path, f"{key}.{os.getpid()}.tmp")
+        with open(temp, 'w') as f:
+            json.dump(asdict(stats), f)
+        os.replace(temp, filename)
+
+        return None
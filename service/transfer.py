@@ -0,0 +1,78 @@
+import os
+
+from b3w import B3W
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Tuple
+
+
+MiB: int = 1048576
+
+
+class Transfer:
+    # Concurrent S3 transfers: large objects go as parallel multipart uploads
+    # and ranged parallel downloads (boto3 transfer manager), many small
+    # objects are moved concurrently by a thread pool. Takes a low-level
+    # boto3 client (thread-safe, unlike resources and their Buckets), so
+    # pipeline workers share one; runs against any S3 stand-in (MinIO, moto)
+    def __init__(self, client: Any, bucket: str, concurrency: int = 8,
+            multipart_threshold: int = 64 * MiB,
+            multipart_chunksize: int = 16 * MiB) -> None:
+        self.client = client
+        self.bucket = bucket
+        self.concurrency = max(1, concurrency)
+        self.config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=self.concurrency,
+            use_threads=True
+        )
+
+    @classmethod
+    def from_b3w(cls, s3: B3W, options: Dict[str, Any] = None) -> 'Transfer':
+        options = options or {}
+        client = s3._B3W__s3r.meta.client
+        return cls(client, s3._B3W__bucket_name,
+                   options.get('concurrency', 8),
+                   options.get('multipart_threshold', 64) * MiB,
+                   options.get('multipart_chunksize', 16) * MiB)
+
+    def ls(self, prefix: str) -> List[str]:
+        # Object keys under the prefix (as B3W.ls)
+        keys: List[str] = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(item['Key'] for item in page.get('Contents', []))
+
+        return keys
+
+    def get(self, s3o: str, filename: str) -> str:
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        self.client.download_file(self.bucket, s3o, filename,
+                                  Config=self.config)
+
+        return filename
+
+    def put(self, filename: str, s3o: str) -> str:
+        self.client.upload_file(filename, self.bucket, s3o,
+                                Config=self.config)
+
+        return s3o
+
+    def get_many(self, pairs: Iterable[Tuple[str, str]]) -> List[str]:
+        # pairs: (S3 object, local filename)
+        return self._map(self.get, pairs)
+
+    def put_many(self, pairs: Iterable[Tuple[str, str]]) -> List[str]:
+        # pairs: (local filename, S3 object)
+        return self._map(self.put, pairs)
+
+    def _map(self, function: Any, pairs: Iterable[Tuple[str, str]]
+        ) -> List[str]:
+        pairs = list(pairs)
+        if len(pairs) < 2:
+            return [function(*pair) for pair in pairs]
+        with ThreadPoolExecutor(min(self.concurrency, len(pairs))) as pool:
+            futures = [pool.submit(function, *pair) for pair in pairs]
+
+        return [future.result() for future in futures]
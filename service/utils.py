@@ -34,6 +34,41 @@ def remove(filename: str) -> None:
     return None
 
 
+def get_rss() -> int:
+    # Current resident set size of this process (bytes, Linux only)
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0
+
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def get_peak_rss() -> int:
+    # Peak resident set size of this process (bytes, Linux only)
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+
+    return 0
+
+
+def reset_peak_rss() -> bool:
+    # Restart the peak from the current RSS (Linux 4.0+, may be denied)
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+
+    return True
+
+
 def print_snapshots(snapshots: List):
     print('\n'.join([f"{i:2d}\t{snapshot.begin_position}"
                      f"\t{snapshot.link}"